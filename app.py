@@ -1,75 +1,569 @@
+import hashlib
+import json
+import multiprocessing
 import os
+import re
+import shutil
+import threading
+import uuid
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, suppress
+from datetime import datetime
 from math import isnan
+from time import monotonic, perf_counter, time
 
 import numpy
 import pandas
-from flask import Flask, request, render_template
+from flask import Flask, Response, g, jsonify, request, render_template, send_file
 from pandas import DataFrame, notnull
 
+from binning import bin_indexes
+from data_file import read_table, write_table
+from model_file import load_model
+
 app = Flask(__name__)
 
+# Continuous terms applied to numeric values that are not factors of the model:
+# column -> ((addition slope, addition intercept) or None, (multiplier slope, multiplier intercept) or None)
+CONTINUOUS_TERMS = {'insurance_price': ((8.0, 0.0), (0.000002356781372541904, 0.9677092756497888)),
+                    'power': (None, (0.0011040866703426102, 0.8993661804773361)),
+                    'engine_capacity': ((60.84013433324293, 1084.2797944627148), None)}
+
 
 class Predictor:
     def __init__(self):
+        self.factors = None
         self.additions = None
         self.multipliers = None
         self.rows = None
+        self.bin_edges = {}
+        self.lookups = None
+        self._bins = None
+        self._vocabularies = {}
+
+    def compile_lookups(self):
+        """Builds per-column tables factor -> (addition, multiplier) of plain floats for single cars."""
+        additions = numpy.asarray(self.additions).tolist()
+        multipliers = numpy.asarray(self.multipliers).tolist()
+        self.lookups = {column: {factor: (additions[position], multipliers[position])
+                                 for factor, position in positions.items()}
+                        for column, positions in self.factors.items()}
+        self._bins = {column: list(edges) for column, edges in self.bin_edges.items()}
 
     @staticmethod
     def _read_data(data_path):
-        dataFrame = pandas.read_csv(data_path, index_col=0)
+        dataFrame = read_table(data_path)
         return dataFrame.where(notnull(dataFrame), None)
 
     def predict_target_value(self, car):
+        if self.lookups is None:
+            self.compile_lookups()
+        lookups = self.lookups
+        bins = self._bins
         target = 0.0
         multiplier = 1.0
-        for column in car:
-            factor = car[column]
-            if column in self.additions and factor in self.additions[column]:
-                target += self.additions[column][factor]
-            if column in self.multipliers and factor in self.multipliers[column]:
-                multiplier *= self.multipliers[column][factor]
-            elif isinstance(factor, float) and not isnan(factor):
-                if column == 'insurance_price':
-                    target += factor * 8
-                    multiplier *= (0.000002356781372541904 * factor + 0.9677092756497888)
-                elif column == 'power':
-                    multiplier *= (0.0011040866703426102 * factor + 0.8993661804773361)
-                elif column == 'engine_capacity':
-                    target += (60.84013433324293 * factor + 1084.2797944627148)
+        for column, value in car.items():
+            factor = value
+            if column in bins and isinstance(value, (int, float)) and value == value:
+                # NaN is the only value that differs from itself; it is looked up as missing below
+                factor = bisect_right(bins[column], value)
+            table = lookups.get(column)
+            entry = None if table is None else table.get(factor)
+            if entry is None and table is not None and factor != factor:
+                # A missing (NaN) cell is the None factor, the same as a form without the field
+                entry = table.get(None)
+            if entry is not None:
+                target += entry[0]
+                multiplier *= entry[1]
+            elif column in CONTINUOUS_TERMS and isinstance(value, float) and not isnan(value):
+                # Continuous terms take the raw value, also in binned columns whose bin is not a factor
+                addition, multiplication = CONTINUOUS_TERMS[column]
+                if addition is not None:
+                    target += addition[0] * value + addition[1]
+                if multiplication is not None:
+                    multiplier *= multiplication[0] * value + multiplication[1]
         return target * multiplier
 
+    def _encode_column(self, column, values):
+        """Returns positions of the column values in the factors vocabulary, -1 for unknown factors.
+
+        Missing values are looked up as the None factor, the same way a form without the field is.
+        """
+        if column not in self._vocabularies:
+            positions = self.factors[column]
+            self._vocabularies[column] = (pandas.Index(list(positions), dtype=object),
+                                          numpy.fromiter(positions.values(), dtype=numpy.int64, count=len(positions)))
+        vocabulary, positions = self._vocabularies[column]
+        none_position = self.factors[column].get(None, -1)
+        if isinstance(values.dtype, pandas.CategoricalDtype):
+            indexes = vocabulary.get_indexer(values.cat.categories)
+            category_positions = numpy.append(numpy.where(indexes >= 0, positions[indexes], -1), none_position)
+            return category_positions[values.cat.codes.to_numpy()]
+        indexes = vocabulary.get_indexer(values)
+        encoded = numpy.where(indexes >= 0, positions[indexes], -1)
+        encoded[values.isna().to_numpy()] = none_position
+        return encoded
+
+    def _encode_bins(self, column, values):
+        """Returns positions of the bins of the column values, the same way as _encode_column."""
+        if column not in self._vocabularies:
+            bin_positions = numpy.full(len(self.bin_edges[column]) + 1, -1, dtype=numpy.int64)
+            for factor, position in self.factors[column].items():
+                if isinstance(factor, int) and 0 <= factor < len(bin_positions):
+                    bin_positions[factor] = position
+            self._vocabularies[column] = bin_positions
+        indexes, numeric = bin_indexes(values, self.bin_edges[column])
+        encoded = numpy.where(numeric, self._vocabularies[column][indexes], -1)
+        encoded[values.isna().to_numpy()] = self.factors[column].get(None, -1)
+        return encoded
+
+    @staticmethod
+    def _continuous_values(values):
+        """Returns float values of the column and the mask of cells that are non-NaN floats."""
+        if values.dtype.kind == 'f':
+            numbers = values.to_numpy(dtype=numpy.float64)
+            return numbers, ~numpy.isnan(numbers)
+        if values.dtype.kind in 'iub':
+            return numpy.zeros(len(values)), numpy.zeros(len(values), dtype=bool)
+        mask = numpy.fromiter((isinstance(value, float) and not isnan(value) for value in values),
+                              dtype=bool, count=len(values))
+        numbers = numpy.zeros(len(values))
+        numbers[mask] = values[mask].to_numpy(dtype=numpy.float64)
+        return numbers, mask
+
+    def predict_target_values(self, data: DataFrame):
+        """Vectorized predict_target_value over every row of the frame."""
+        targets = numpy.zeros(len(data))
+        multipliers = numpy.ones(len(data))
+        for column in data.columns:
+            values = data[column]
+            if column in self.factors:
+                if column in self.bin_edges:
+                    encoded = self._encode_bins(column, values)
+                else:
+                    encoded = self._encode_column(column, values)
+                known = encoded >= 0
+                targets += numpy.where(known, numpy.asarray(self.additions)[encoded], 0.0)
+                multipliers *= numpy.where(known, numpy.asarray(self.multipliers)[encoded], 1.0)
+            else:
+                known = numpy.zeros(len(data), dtype=bool)
+            if column in CONTINUOUS_TERMS:
+                numbers, mask = self._continuous_values(values)
+                mask &= ~known
+                addition, multiplication = CONTINUOUS_TERMS[column]
+                if addition is not None:
+                    targets += numpy.where(mask, addition[0] * numbers + addition[1], 0.0)
+                if multiplication is not None:
+                    multipliers *= numpy.where(mask, multiplication[0] * numbers + multiplication[1], 1.0)
+        return targets * multipliers
+
     def _predict_target_values(self, data=None):
         if data is None:
             return [self.predict_target_value(instance) for instance in self.rows]
         else:
-            return [self.predict_target_value({column: factor for column, factor in instance.items()}) for
-                    index, instance in data.iterrows()]
+            return self.predict_target_values(data)
 
     def predict(self, data_path, prediction_path, column_name='Predicted', index_name='Id'):
         print('\rReading data...', end='')
         data = self._read_data(data_path)
         print('\rPredicting prices...', end='')
         prices = self._predict_target_values(data)
-        indexes = [index for index, data in data.iterrows()]
-        cars_prices = DataFrame(prices, index=indexes, columns=[column_name]).rename_axis(index_name)
+        cars_prices = DataFrame(prices, index=data.index, columns=[column_name]).rename_axis(index_name)
         print('\rWriting results...', end='')
-        cars_prices.to_csv(prediction_path)
+        write_table(cars_prices, prediction_path)
 
 
 class LoadingPredictor(Predictor):
     def __init__(self, filename, ignore_columns: list):
         super().__init__()
         print('Loading values for factors...', end='')
-        [additions, multipliers] = numpy.load(filename, allow_pickle=True)
-        self.additions = {column: {factor: additions[column][factor]
-                                   for factor in additions[column]}
-                          for column in additions
-                          if column not in ignore_columns}
-        self.multipliers = {column: {factor: multipliers[column][factor]
-                                     for factor in multipliers[column]}
-                            for column in multipliers
-                            if column not in ignore_columns}
+        self.header, vocabularies, values = load_model(filename)
+        position = 0
+        self.factors = {}
+        for column, factors in vocabularies.items():
+            if column not in ignore_columns:
+                self.factors[column] = {factor: position + index for index, factor in enumerate(factors)}
+            position += len(factors)
+        self.bin_edges = {column: edges for column, edges in self.header['bins'].items() if column in self.factors}
+        self.additions = values[0]
+        self.multipliers = values[1]
+        self.compile_lookups()
+
+
+def _model_version(content):
+    return hashlib.sha1(content).hexdigest()[:12]
+
+
+LoadedModel = namedtuple('LoadedModel', ['predictor', 'version', 'loaded_at', 'signature', 'load_seconds'])
+
+
+class ModelRegistry:
+    """Process-wide holder of the serving model.
+
+    The model file is loaded once and shared by every request. On each access the file is
+    checked by inode, modification time and size; when it changes the new model is loaded
+    and swapped in as a whole, so requests see either the old model or the new one.
+    """
+
+    def __init__(self, filename, ignore_columns: list = None):
+        self.filename = filename
+        self.ignore_columns = ignore_columns if ignore_columns is not None else []
+        self.model = None
+        self._lock = threading.Lock()
+
+    def _signature(self):
+        stat = os.stat(self.filename)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _file_version(self):
+        with open(self.filename, 'rb') as file:
+            return _model_version(file.read())
+
+    def get(self):
+        model = self.model
+        try:
+            signature = self._signature()
+        except FileNotFoundError:
+            if model is None:
+                raise
+            return model
+        if model is not None and model.signature == signature:
+            return model
+        with self._lock:
+            model = self.model
+            if model is not None and model.signature == signature:
+                return model
+            start = perf_counter()
+            try:
+                version = self._file_version()
+                predictor = LoadingPredictor(self.filename, self.ignore_columns)
+            except FileNotFoundError:
+                if model is None:
+                    raise
+                return model
+            except Exception as error:
+                # The file may be in the middle of being copied; keep the current model and retry later.
+                if model is None:
+                    raise
+                print(f'Failed to reload {self.filename}: {error}', flush=True)
+                return model
+            self.model = LoadedModel(predictor, version, datetime.now(), signature, perf_counter() - start)
+            print(f' loaded {self.filename} version {version}', flush=True)
+            return self.model
+
+
+class PredictionCache:
+    """Bounded LRU cache of predicted prices keyed on the parsed car features.
+
+    Entries expire after ttl seconds. The cache is cleared as soon as another model version is
+    seen, and prices computed by an old model are not stored, so a swapped model.npy never
+    serves stale prices.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_price(self, model: LoadedModel, car: dict):
+        if self.size <= 0:
+            return model.predictor.predict_target_value(car)
+        key = tuple(car.items())
+        now = monotonic()
+        with self._lock:
+            if model.version != self._version:
+                self._entries.clear()
+                self._version = model.version
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        price = model.predictor.predict_target_value(car)
+        with self._lock:
+            if model.version == self._version:
+                self._entries[key] = (price, now + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return price
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels) + '}' if labels else ''
+
+
+class Metrics:
+    """Request counters and latency histograms of this server process in the Prometheus text format.
+
+    Every gunicorn worker keeps its own metrics, so a scrape describes the worker that answered it.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    DESCRIPTIONS = {'car_price_request_duration_seconds': 'Request latency by route.',
+                    'car_price_request_phase_duration_seconds': 'Request latency by route and phase.'}
+
+    def __init__(self):
+        self.requests = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def phase(self, phase):
+        """Observes the duration of the block as a phase of the current request."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('car_price_request_phase_duration_seconds', perf_counter() - start,
+                         route=_route(), phase=phase)
+
+    def count_request(self, route, method, status):
+        key = (route, method, status)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def render(self, model, cache_stats: dict):
+        lines = ['# HELP car_price_requests_total Requests by route, method and status.',
+                 '# TYPE car_price_requests_total counter']
+        with self._lock:
+            for (route, method, status), count in sorted(self.requests.items()):
+                labels = _labels((('route', route), ('method', method), ('status', status)))
+                lines.append(f'car_price_requests_total{labels} {count}')
+            histograms = sorted((key, (list(buckets), total, count))
+                                for key, (buckets, total, count) in self.histograms.items())
+        for name, description in self.DESCRIPTIONS.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+            for (histogram_name, labels), (buckets, total, count) in histograms:
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_labels(labels)} {total}')
+                lines.append(f'{name}_count{_labels(labels)} {count}')
+        if model is not None:
+            lines += ['# HELP car_price_model_info Active model version.',
+                      '# TYPE car_price_model_info gauge',
+                      f'car_price_model_info{_labels((("version", model.version),))} 1',
+                      '# HELP car_price_model_load_duration_seconds Duration of the active model load.',
+                      '# TYPE car_price_model_load_duration_seconds gauge',
+                      f'car_price_model_load_duration_seconds {model.load_seconds}',
+                      '# HELP car_price_model_loaded_timestamp_seconds Time the active model was loaded.',
+                      '# TYPE car_price_model_loaded_timestamp_seconds gauge',
+                      f'car_price_model_loaded_timestamp_seconds {model.loaded_at.timestamp()}']
+        for name in ('hits', 'misses', 'evictions'):
+            lines += [f'# TYPE car_price_prediction_cache_{name}_total counter',
+                      f'car_price_prediction_cache_{name}_total {cache_stats[name]}']
+        lines += ['# TYPE car_price_prediction_cache_entries gauge',
+                  f'car_price_prediction_cache_entries {cache_stats["size"]}']
+        return '\n'.join(lines) + '\n'
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _write_job_status(directory, **fields):
+    """Merges fields into the status file of the job; the file is replaced atomically."""
+    path = os.path.join(directory, 'status.json')
+    with open(path) as file:
+        status = json.load(file)
+    status.update(fields)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(status, file)
+    os.replace(path + '.tmp', path)
+
+
+def _run_job(directory, model_path, chunk_size):
+    """Scores input.csv of the job with a copy of the current model and records the version of that copy.
+
+    The input is removed once the job is done or failed, only status.json and result.csv are kept.
+    """
+    from predict import stream_predict
+    job_model_path = os.path.join(directory, 'model.npy')
+    try:
+        with open(model_path, 'rb') as file:
+            content = file.read()
+        with open(job_model_path, 'wb') as file:
+            file.write(content)
+        rows_count = -1
+        last = b'\n'
+        with open(os.path.join(directory, 'input.csv'), 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                rows_count += block.count(b'\n')
+                last = block[-1:]
+        rows_count = max(rows_count + (last != b'\n'), 0)
+        _write_job_status(directory, state='running', started=datetime.now().isoformat(), rows=rows_count,
+                          model_version=_model_version(content))
+        result_path = os.path.join(directory, 'result.csv')
+        input_path = os.path.join(directory, 'input.csv')
+        stream_predict(job_model_path, input_path, result_path + '.tmp', chunk_size=chunk_size,
+                       progress=lambda processed: _write_job_status(directory, processed=processed))
+        os.replace(result_path + '.tmp', result_path)
+        _write_job_status(directory, state='done', finished=datetime.now().isoformat())
+    except Exception as error:
+        _write_job_status(directory, state='failed', finished=datetime.now().isoformat(), error=str(error))
+    finally:
+        for name in ('model.npy', 'input.csv'):
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(directory, name))
+
+
+class JobQueue:
+    """Bulk scoring jobs run by a local process pool.
+
+    Every job is a directory with the uploaded input.csv, status.json and, once done, result.csv, so
+    any server process can report on a job. Jobs are scored chunk by chunk outside the request
+    threads; at most size jobs are queued or running per server process, further ones are rejected.
+    Finished jobs are deleted ttl seconds after their last status change.
+    """
+
+    def __init__(self, directory, workers: int, size: int, chunk_size: int, ttl: float):
+        self.directory = os.path.abspath(directory)
+        self.workers = workers
+        self.size = size
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _job_directory(self, job_id):
+        if re.fullmatch('[0-9a-f]{32}', job_id) is None:
+            return None
+        return os.path.join(self.directory, job_id)
+
+    def _submit(self, directory):
+        with self._lock:
+            for _ in range(2):
+                if self._executor is None:
+                    # Workers are spawned rather than forked from a process running request threads
+                    self._executor = ProcessPoolExecutor(self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                try:
+                    return self._executor.submit(_run_job, directory, models.filename, self.chunk_size)
+                except BrokenProcessPool:
+                    self._executor = None
+        raise BrokenProcessPool('Job workers cannot be started')
+
+    def delete_expired(self):
+        """Deletes the directories of done and failed jobs whose status has not changed for ttl seconds."""
+        if not os.path.isdir(self.directory):
+            return
+        expired = time() - self.ttl
+        for job_id in os.listdir(self.directory):
+            status = self.status(job_id)
+            if status is None or status['state'] not in ('done', 'failed'):
+                continue
+            with suppress(FileNotFoundError):
+                if os.path.getmtime(os.path.join(self.directory, job_id, 'status.json')) < expired:
+                    shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+
+    def submit(self, stream):
+        """Stores the uploaded CSV stream and queues its scoring; returns the job id or None when full."""
+        self.delete_expired()
+        with self._lock:
+            if self.pending >= self.size:
+                return None
+            self.pending += 1
+        job_id = uuid.uuid4().hex
+        directory = os.path.join(self.directory, job_id)
+        try:
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'input.csv'), 'wb') as file:
+                shutil.copyfileobj(stream, file)
+            with open(os.path.join(directory, 'status.json'), 'w') as file:
+                json.dump({'id': job_id, 'state': 'queued', 'created': datetime.now().isoformat(),
+                           'model_version': None, 'rows': None, 'processed': 0}, file)
+            future = self._submit(directory)
+        except BaseException:
+            with self._lock:
+                self.pending -= 1
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        future.add_done_callback(lambda done: self._finished(done, directory))
+        return job_id
+
+    def _finished(self, future, directory):
+        with self._lock:
+            self.pending -= 1
+        if future.exception() is not None:
+            # The worker process died, so _run_job could not record the failure itself
+            _write_job_status(directory, state='failed', finished=datetime.now().isoformat(),
+                              error=str(future.exception()))
+
+    def status(self, job_id):
+        directory = self._job_directory(job_id)
+        if directory is None or not os.path.exists(os.path.join(directory, 'status.json')):
+            return None
+        with open(os.path.join(directory, 'status.json')) as file:
+            return json.load(file)
+
+    def result_path(self, job_id):
+        return os.path.join(self._job_directory(job_id), 'result.csv')
+
+
+models = ModelRegistry('model.npy', [])
+prediction_cache = PredictionCache(int(os.environ.get('PREDICTION_CACHE_SIZE', 10000)),
+                                   float(os.environ.get('PREDICTION_CACHE_TTL', 3600)))
+metrics = Metrics()
+jobs = JobQueue(os.environ.get('JOBS_DIRECTORY', 'jobs'), int(os.environ.get('JOBS_WORKERS', 1)),
+               int(os.environ.get('JOBS_QUEUE_SIZE', 4)), int(os.environ.get('JOBS_CHUNK_SIZE', 10000)),
+               float(os.environ.get('JOBS_TTL', 86400)))
+
+
+@app.before_request
+def start_timer():
+    g.request_start = perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    route = _route()
+    metrics.count_request(route, request.method, response.status_code)
+    if 'request_start' in g:
+        metrics.observe('car_price_request_duration_seconds', perf_counter() - g.request_start, route=route)
+    return response
+
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.render(models.model, prediction_cache.stats()), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/')
@@ -80,42 +574,135 @@ def index_page():
 def int_try_parse(value):
     try:
         return int(value)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
 def float_try_parse(value):
     try:
         return float(value)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
+def parse_car(values):
+    """Builds the car features from form arguments or a JSON object."""
+    return {'engine_capacity': float_try_parse(values.get('engine_capacity', None)),
+            'type': values.get('type', None),
+            'registration_year': int_try_parse(values.get('registration_year', None)),
+            'gearbox': values.get('gearbox', None),
+            'power': int_try_parse(values.get('power', None)),
+            'model': values.get('model', None),
+            'mileage': int_try_parse(values.get('mileage', None)),
+            'fuel': values.get('fuel', None),
+            'brand': values.get('brand', None),
+            'damage': float_try_parse(values.get('damage', None)),
+            'insurance_price': float_try_parse(values.get('insurance_price', None))}
+
+
 @app.route('/version/')
 def version():
-    return render_template("version.html")
+    try:
+        model = models.get()
+    except FileNotFoundError:
+        return render_template("version.html")
+    return render_template("version.html", model_version=model.version,
+                           model_loaded_at=model.loaded_at.isoformat(sep=' ', timespec='seconds'),
+                           cache=prediction_cache.stats())
+
+
+@app.route('/healthz')
+def healthz():
+    """Readiness probe: 200 once the model is loaded, 503 while model.npy is not available."""
+    try:
+        model = models.get()
+    except FileNotFoundError:
+        return jsonify(status='loading'), 503
+    return jsonify(status='ready', model_version=model.version, pid=os.getpid())
 
 
 @app.route('/predict/')
 def calculate_page():
-    car = {'engine_capacity': float_try_parse(request.args.get('engine_capacity', None)),
-           'type': request.args.get('type', None),
-           'registration_year': int_try_parse(request.args.get('registration_year', None)),
-           'gearbox': request.args.get('gearbox', None),
-           'power': int_try_parse(request.args.get('power', None)),
-           'model': request.args.get('model', None),
-           'mileage': int_try_parse(request.args.get('mileage', None)),
-           'fuel': request.args.get('fuel', None),
-           'brand': request.args.get('brand', None),
-           'damage': float_try_parse(request.args.get('damage', None)),
-           'insurance_price': float_try_parse(request.args.get('insurance_price', None))}
+    with metrics.phase('parse'):
+        car = parse_car(request.args)
     try:
-        return render_template("index.html", price=str(LoadingPredictor('model.npy', []).predict_target_value(car)),
-                               **car)
+        with metrics.phase('model_load'):
+            model = models.get()
     except FileNotFoundError:
         return "Error loading model.npy"
+    with metrics.phase('predict'):
+        price = prediction_cache.get_price(model, car)
+    with metrics.phase('render'):
+        return render_template("index.html", price=str(price), **car)
+
+
+def _is_scalar(value):
+    # Lists and objects cannot be looked up as factors
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+app.config['MAX_BATCH_SIZE'] = int(os.environ.get('MAX_BATCH_SIZE', 10000))
+
+
+@app.route('/api/predict', methods=['POST'])
+def predict_api():
+    with metrics.phase('parse'):
+        cars = request.get_json(silent=True)
+        if not isinstance(cars, list) or not all(isinstance(car, dict) and all(map(_is_scalar, car.values()))
+                                                 for car in cars):
+            return jsonify(error='Expected a JSON array of cars'), 400
+        if len(cars) > app.config['MAX_BATCH_SIZE']:
+            return jsonify(error=f'At most {app.config["MAX_BATCH_SIZE"]} cars per request'), 413
+        # Object columns keep parsed values as they are, the same way predict_target_value sees them
+        data = DataFrame([parse_car(car) for car in cars], columns=list(parse_car({})), dtype=object)
+    try:
+        with metrics.phase('model_load'):
+            predictor = models.get().predictor
+    except FileNotFoundError:
+        return jsonify(error='Error loading model.npy'), 503
+    with metrics.phase('predict'):
+        prices = predictor.predict_target_values(data)
+    with metrics.phase('render'):
+        return jsonify(prices.tolist())
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queues scoring of a CSV sent as the 'file' form field or as the request body."""
+    try:
+        models.get()
+    except FileNotFoundError:
+        return jsonify(error='Error loading model.npy'), 503
+    upload = request.files.get('file')
+    job_id = jobs.submit(upload.stream if upload is not None else request.stream)
+    if job_id is None:
+        return jsonify(error=f'At most {jobs.size} jobs can be queued, retry later'), 429
+    return jsonify(id=job_id, status=f'/jobs/{job_id}', result=f'/jobs/{job_id}/result'), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify(error='Unknown job'), 404
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify(error='Unknown job'), 404
+    if status['state'] != 'done':
+        return jsonify(status), 409
+    return send_file(jobs.result_path(job_id), mimetype='text/csv', as_attachment=True,
+                     download_name=f'{job_id}.csv')
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    try:
+        models.get()
+    except FileNotFoundError:
+        print(f'{models.filename} is not found, it will be loaded when available')
     app.run(host='0.0.0.0', port=port)
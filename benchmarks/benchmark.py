@@ -0,0 +1,176 @@
+import contextlib
+import getopt
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy  # noqa: E402
+import pandas  # noqa: E402
+
+import app  # noqa: E402
+from train import TrainingPredictor, default_ignore  # noqa: E402
+
+TARGET = 'price'
+PREDICT_QUERY = {'engine_capacity': '', 'type': 'suv', 'registration_year': '2010', 'gearbox': 'auto',
+                 'power': '200', 'model': 'x5', 'mileage': '150000', 'fuel': 'diesel', 'brand': 'bmw',
+                 'damage': '0', 'insurance_price': ''}
+
+
+def scale_data(data_path, scale, directory):
+    """Writes data_path repeated scale times with a fresh index and returns the new path."""
+    if scale == 1:
+        return data_path
+    data = pandas.read_csv(data_path, index_col=0)
+    scaled = pandas.concat([data] * scale, ignore_index=True)
+    path = os.path.join(directory, f'{scale}x_{os.path.basename(data_path)}')
+    scaled.to_csv(path)
+    return path
+
+
+def measure(function, repeats):
+    """Returns the best time of repeats calls of the function in seconds."""
+    best = None
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            function()
+            elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(scales, repeats, requests_count):
+    """Measures every benchmark; single car predictions are called 100 times as often as /predict/."""
+    results = []
+
+    def record(name, scale, rows, seconds, **extra):
+        results.append(dict(name=name, scale=scale, rows=rows, seconds=seconds, **extra))
+        print(f'{name} x{scale}: {seconds:.4f} s', flush=True)
+
+    model_path = os.path.join(ROOT, 'model.npy')
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            training_path = scale_data(os.path.join(ROOT, 'training.csv'), scale, directory)
+            validating_path = scale_data(os.path.join(ROOT, 'validating.csv'), scale, directory)
+
+            predictors = []
+            seconds = measure(lambda: predictors.append(TrainingPredictor(training_path, TARGET)), repeats)
+            predictor = predictors[-1]
+            rows = len(predictor.target_values)
+            record('training_predictor_init', scale, rows, seconds)
+
+            predictor.ignore = default_ignore()
+            record('train_once', scale, rows, measure(predictor._train_once, repeats))
+            record('predict_target_values', scale, rows, measure(predictor.predict_target_values, repeats))
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                loading_predictor = app.LoadingPredictor(model_path, [])
+            validating = pandas.read_csv(validating_path, index_col=0)
+            record('batch_predict_target_values', scale, len(validating),
+                   measure(lambda: loading_predictor.predict_target_values(validating), repeats))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        loading_predictor = app.LoadingPredictor(model_path, [])
+    car = app.parse_car(PREDICT_QUERY)
+    calls_count = requests_count * 100
+
+    def predict_cars():
+        for _ in range(calls_count):
+            loading_predictor.predict_target_value(car)
+
+    seconds = measure(predict_cars, repeats)
+    record('predict_target_value', 1, calls_count, seconds, seconds_per_call=seconds / calls_count)
+
+    app.models = app.ModelRegistry(model_path, [])
+    app.prediction_cache.size = 0
+    client = app.app.test_client()
+
+    def request_predictions():
+        for _ in range(requests_count):
+            client.get('/predict/', query_string=PREDICT_QUERY)
+
+    seconds = measure(request_predictions, repeats)
+    record('http_predict', 1, requests_count, seconds, seconds_per_request=seconds / requests_count)
+    return {'environment': {'python': platform.python_version(),
+                            'numpy': numpy.__version__,
+                            'pandas': pandas.__version__,
+                            'machine': platform.machine(),
+                            'cpus': os.cpu_count()},
+            'results': results}
+
+
+def compare(report, baseline, tolerance, minimum_slowdown):
+    """Prints time ratios against the baseline and returns the number of regressions.
+
+    A step regresses when it is slower than the baseline by more than tolerance and by more than
+    minimum_slowdown seconds, so timer noise of millisecond steps is not reported.
+    """
+    baseline_seconds = {(result['name'], result['scale']): result['seconds'] for result in baseline['results']}
+    regressions = 0
+    for result in report['results']:
+        key = (result['name'], result['scale'])
+        if key not in baseline_seconds:
+            continue
+        ratio = result['seconds'] / baseline_seconds[key]
+        regressed = ratio > 1 + tolerance and result['seconds'] - baseline_seconds[key] > minimum_slowdown
+        regressions += regressed
+        print(f'{result["name"]} x{result["scale"]}: {ratio:.2f}x baseline{" REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main(argv):
+    scales = [1, 10, 100]
+    repeats = 3
+    requests_count = 200
+    output_file = None
+    baseline_file = None
+    tolerance = 0.2
+    minimum_slowdown = 0.01
+    help_message = ' [-s <comma_separated_scales> -r <repeats> -n <http_requests_count>' \
+                   ' -o <output_json_path> -b <baseline_json_path> -l <tolerated_slowdown>' \
+                   ' -m <tolerated_slowdown_seconds>]'
+    try:
+        opts, args = getopt.getopt(argv, "hs:r:n:o:b:l:m:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-s":
+            scales = [int(scale) for scale in arg.split(',')]
+        elif opt == "-r":
+            repeats = int(arg)
+        elif opt == "-n":
+            requests_count = int(arg)
+        elif opt == "-o":
+            output_file = arg
+        elif opt == "-b":
+            baseline_file = arg
+        elif opt == "-l":
+            tolerance = float(arg)
+        elif opt == "-m":
+            minimum_slowdown = float(arg)
+    report = run(scales, repeats, requests_count)
+    if output_file is not None:
+        with open(output_file, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if baseline_file is not None:
+        with open(baseline_file) as file:
+            baseline = json.load(file)
+        if compare(report, baseline, tolerance, minimum_slowdown) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+import getopt
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+from multiprocessing import Pool
+from time import perf_counter, sleep
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmark import PREDICT_QUERY  # noqa: E402
+
+PREDICT_PATH = '/predict/?' + urlencode(PREDICT_QUERY)
+
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+def start_server(port, workers, threads):
+    """Starts gunicorn with the production configuration and waits until /healthz reports ready."""
+    environment = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads),
+                       MODEL_CHECK_INTERVAL='0', PREDICTION_CACHE_SIZE='0')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--log-level', 'warning',
+                               'app:app'], cwd=ROOT, env=environment)
+    for _ in range(600):
+        if server.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with code {server.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/healthz')
+            if connection.getresponse().status == 200:
+                return server
+        except OSError:
+            pass
+        sleep(0.1)
+    server.terminate()
+    raise RuntimeError('gunicorn did not become ready')
+
+
+def _send_requests(task):
+    """Sends requests_count keep-alive requests over one connection and returns the failures count."""
+    port, requests_count = task
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    failures = 0
+    for _ in range(requests_count):
+        connection.request('GET', PREDICT_PATH)
+        response = connection.getresponse()
+        response.read()
+        failures += response.status != 200
+    connection.close()
+    return failures
+
+
+def run(workers_counts, threads, clients, requests_count):
+    results = []
+    with Pool(clients) as pool:
+        for workers in workers_counts:
+            port = free_port()
+            server = start_server(port, workers, threads)
+            try:
+                pool.map(_send_requests, [(port, 10)] * clients)
+                start = perf_counter()
+                failures = sum(pool.map(_send_requests, [(port, requests_count // clients)] * clients))
+                seconds = perf_counter() - start
+            finally:
+                server.terminate()
+                server.wait()
+            sent = requests_count // clients * clients
+            results.append({'workers': workers, 'threads': threads, 'clients': clients, 'requests': sent,
+                            'failures': failures, 'seconds': seconds, 'requests_per_second': sent / seconds})
+            print(f'{workers} workers x {threads} threads: {sent / seconds:.0f} req/s, {failures} failures',
+                  flush=True)
+    return {'cpus': os.cpu_count(), 'results': results}
+
+
+def main(argv):
+    workers_counts = [1, 2, 4]
+    threads = 4
+    clients = 8
+    requests_count = 2000
+    output_file = None
+    help_message = ' [-w <comma_separated_workers_counts> -t <threads_per_worker> -c <concurrent_clients>' \
+                   ' -n <requests_count> -o <output_json_path>]'
+    try:
+        opts, args = getopt.getopt(argv, "hw:t:c:n:o:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-w":
+            workers_counts = [int(workers) for workers in arg.split(',')]
+        elif opt == "-t":
+            threads = int(arg)
+        elif opt == "-c":
+            clients = int(arg)
+        elif opt == "-n":
+            requests_count = int(arg)
+        elif opt == "-o":
+            output_file = arg
+    report = run(workers_counts, threads, clients, requests_count)
+    if output_file is not None:
+        with open(output_file, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
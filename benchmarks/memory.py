@@ -0,0 +1,135 @@
+import contextlib
+import getopt
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy  # noqa: E402
+
+from benchmark import TARGET, scale_data  # noqa: E402
+from data_file import read_table  # noqa: E402
+from train import TrainingPredictor  # noqa: E402
+
+VARIANTS = ('lists', 'arrays', 'memmap')
+
+
+def _status(field):
+    """Returns the field of /proc/self/status in MiB, None where /proc is not available."""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in MiB.
+
+    VmHWM is reset by exec, unlike ru_maxrss on Linux, so spawned processes do not report the peak of their parent.
+    """
+    peak = _status('VmHWM')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+    return peak
+
+
+def anonymous_rss():
+    """Returns the resident memory of this process not backed by files in MiB; memory-mapped arrays are not counted."""
+    return _status('RssAnon')
+
+
+def list_state(data, target):
+    """Builds the per-row dicts and lists the trainer kept before its state was moved to arrays."""
+    data_no_target = data.drop(columns=[target]).astype(object)
+    data_no_target = data_no_target.where(data_no_target.notna(), None)
+    factors_instances = {}
+    for column in data_no_target:
+        factors_instances[column] = defaultdict(list)
+        for index, factor in enumerate(data_no_target[column]):
+            factors_instances[column][factor].append(index)
+    additions = {column: {factor: 0.0 for factor in factors_instances[column]} for column in factors_instances}
+    multipliers = {column: {factor: 1.0 for factor in factors_instances[column]} for column in factors_instances}
+    rows = [{column: factor for column, factor in row.items()} for index, row in data_no_target.iterrows()]
+    current_targets = numpy.zeros(len(rows)).tolist()
+    instance_multipliers = numpy.ones(len(rows)).tolist()
+    return rows, factors_instances, additions, multipliers, current_targets, instance_multipliers
+
+
+def measure(variant, data_path, directory):
+    """Builds the training state of the variant and returns peak RSS after every step; runs in a fresh process."""
+    result = {'imported': peak_rss()}
+    data = read_table(data_path)
+    result['read'] = peak_rss()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if variant == 'lists':
+            state = list_state(data, TARGET)
+        else:
+            state = TrainingPredictor(data, TARGET, memmap_directory=directory if variant == 'memmap' else None)
+    result['setup'] = peak_rss()
+    del data
+    result['retained_anonymous'] = anonymous_rss()
+    if variant != 'lists':
+        with contextlib.redirect_stdout(io.StringIO()), numpy.errstate(divide='ignore'):
+            state._train_once()
+        result['train_once'] = peak_rss()
+    return result
+
+
+def run(scales, variants):
+    """Measures every variant at every scale, each in its own spawned process."""
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            data_path = scale_data(os.path.join(ROOT, 'training.csv'), scale, directory)
+            rows = len(read_table(data_path, [TARGET]))
+            for variant in variants:
+                with context.Pool(1) as pool:
+                    memmap_directory = os.path.join(directory, f'{variant}_{scale}')
+                    measured = pool.apply(measure, (variant, data_path, memmap_directory))
+                results.append(dict(variant=variant, scale=scale, rows=rows, **measured))
+                print(f'{variant} x{scale}: ' + ', '.join(f'{step} {rss:.0f} MiB' for step, rss in measured.items()
+                                                          if rss is not None), flush=True)
+    return results
+
+
+def main(argv):
+    scales = [1, 10]
+    variants = list(VARIANTS)
+    output_file = None
+    help_message = ' [-s <comma_separated_scales> -v <comma_separated_variants> -o <output_json_path>]'
+    try:
+        opts, args = getopt.getopt(argv, "hs:v:o:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-s":
+            scales = [int(scale) for scale in arg.split(',')]
+        elif opt == "-v":
+            variants = arg.split(',')
+        elif opt == "-o":
+            output_file = arg
+    results = run(scales, variants)
+    if output_file is not None:
+        with open(output_file, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
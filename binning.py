@@ -0,0 +1,55 @@
+"""Binning of continuous columns.
+
+A binned column is described by its inner bin edges: value v falls in bin ``searchsorted(edges, v,
+side='right')``, so values below the first edge share bin 0 and values above the last edge share the
+last bin. Bin numbers replace the values as factors of the column; missing values stay missing.
+"""
+import numpy
+import pandas
+
+METHODS = ('quantile', 'width')
+
+
+def fit_bins(values, method: str, count: int):
+    """Returns inner edges of at most count bins of the numeric values.
+
+    'quantile' bins hold about the same number of values, 'width' bins split the value range evenly.
+    """
+    numbers = pandas.to_numeric(values, errors='coerce').to_numpy(dtype=numpy.float64)
+    numbers = numbers[~numpy.isnan(numbers)]
+    if len(numbers) == 0 or count < 2:
+        return []
+    if method == 'quantile':
+        edges = numpy.quantile(numbers, numpy.linspace(0, 1, count + 1)[1:-1])
+    elif method == 'width':
+        edges = numpy.linspace(numbers.min(), numbers.max(), count + 1)[1:-1]
+    else:
+        raise ValueError(f'Unknown binning method {method}, expected one of {METHODS}')
+    return numpy.unique(edges).tolist()
+
+
+def bin_indexes(values, edges):
+    """Returns bin numbers of the values and the mask of numeric values; other cells get bin 0."""
+    numbers = pandas.to_numeric(values, errors='coerce').to_numpy(dtype=numpy.float64)
+    mask = ~numpy.isnan(numbers)
+    indexes = numpy.searchsorted(numpy.asarray(edges, dtype=numpy.float64), numbers, side='right')
+    return numpy.where(mask, indexes, 0), mask
+
+
+def bucketize(values, edges):
+    """Returns the values with numbers replaced by their bin numbers; missing cells are kept as they are."""
+    indexes, mask = bin_indexes(values, edges)
+    binned = values.astype(object)
+    binned[mask] = indexes[mask].tolist()
+    return binned
+
+
+def parse_bins(argument: str):
+    """Parses 'column:method:count,...' into {column: (method, count)}."""
+    bins = {}
+    for item in argument.split(','):
+        column, method, count = item.split(':')
+        if method not in METHODS:
+            raise ValueError(f'Unknown binning method {method}, expected one of {METHODS}')
+        bins[column] = (method, int(count))
+    return bins
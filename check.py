@@ -2,7 +2,8 @@ import getopt
 import sys
 
 import numpy
-import pandas
+
+from data_file import read_table
 
 
 def mean_absolute_percentage_error(y_true, y_pred):
@@ -11,8 +12,8 @@ def mean_absolute_percentage_error(y_true, y_pred):
 
 
 def check(input_valid_data_path, input_predicted_targets_path, target: str):
-    validating_data = pandas.read_csv(input_valid_data_path, index_col=0)
-    predicted_data_frame = pandas.read_csv(input_predicted_targets_path, index_col=0)
+    validating_data = read_table(input_valid_data_path, columns=[target])
+    predicted_data_frame = read_table(input_predicted_targets_path, columns=["Predicted"])
     original_prices = validating_data[target].values
     predicted_prices = predicted_data_frame["Predicted"].values
     error = mean_absolute_percentage_error(original_prices, predicted_prices)
@@ -0,0 +1,67 @@
+import contextlib
+import getopt
+import io
+import sys
+
+import numpy as np
+from pandas import DataFrame
+
+from app import LoadingPredictor, parse_car
+from data_file import read_table
+
+
+def mismatches_count(name, single, batch):
+    """Prints and returns the number of cars whose single and batch prices are not identical."""
+    different = np.flatnonzero(~((single == batch) | (np.isnan(single) & np.isnan(batch))))
+    for index in different[:10]:
+        print(f'{name} car #{index}: {single[index]} single, {batch[index]} batch')
+    print(f'{name}: {len(different)} mismatches in {len(single)} cars')
+    return len(different)
+
+
+def check(model_path, data_path, target=None):
+    """Compares predict_target_value with predict_target_values on every row of the data.
+
+    Rows are compared as they are read from the file (predict.py) and parsed the way the service
+    parses them, as single cars (/predict/) and as an object frame (/api/predict).
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        predictor = LoadingPredictor(model_path, [])
+    data = read_table(data_path)
+    if target is not None and target in data:
+        data = data.drop(columns=[target])
+    rows = data.to_dict('records')
+    single = np.array([predictor.predict_target_value(row) for row in rows])
+    mismatches = mismatches_count('file', single, predictor.predict_target_values(data))
+    cars = [parse_car(row) for row in rows]
+    single = np.array([predictor.predict_target_value(car) for car in cars])
+    batch = predictor.predict_target_values(DataFrame(cars, columns=list(parse_car({})), dtype=object))
+    return mismatches + mismatches_count('service', single, batch)
+
+
+def main(argv):
+    model_file = 'model.npy'
+    input_file = 'validating.csv'
+    target = 'price'
+    help_message = ' [-m <model_path> -i <input_data_path> -g <target>]'
+    try:
+        opts, args = getopt.getopt(argv, "hm:i:g:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-m":
+            model_file = arg
+        elif opt == "-i":
+            input_file = arg
+        elif opt == "-g":
+            target = arg
+    if check(model_file, input_file, target) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+import getopt
+import sys
+
+import numpy as np
+
+from train import get_optimal_addition, get_optimal_multiplier
+
+
+def sign(x):
+    return x and (-1 if x < 0 else 1)
+
+
+class Entity:
+    def __init__(self, target_value, predicted_value, multiplier):
+        self.target_value = target_value
+        self.predicted_value = predicted_value
+        self.multiplier = multiplier
+
+    def get_difference(self):
+        return (self.target_value - self.predicted_value) / self.multiplier
+
+    def get_coefficient(self):
+        return self.target_value / self.predicted_value
+
+    def get_mape_addition_derivative(self):
+        return self.multiplier * sign(self.get_difference()) / self.target_value
+
+    def get_mape_multiplier_derivative(self, current_factor_multiplier):
+        return self.predicted_value / current_factor_multiplier * sign(self.get_difference()) / self.target_value
+
+
+def entity_optimal_addition(target_values, predicted_values, multipliers):
+    """Reference per-entity implementation of train.get_optimal_addition."""
+    entities = [Entity(target_value, predicted_value, multiplier)
+                for target_value, predicted_value, multiplier in zip(target_values, predicted_values, multipliers)]
+    entities.sort(key=lambda entity: entity.get_difference())
+    derivative = sum([entity.get_mape_addition_derivative() for entity in entities])
+    difference = 0
+    direction = 1
+    if derivative < 0:
+        direction = -1
+        entities.reverse()
+    if derivative != 0:
+        for entity in entities:
+            if derivative * direction < 0:
+                break
+            if entity.get_difference() * direction > 0:
+                difference = entity.get_difference()
+                derivative -= entity.get_mape_addition_derivative()
+                entity.predicted_value = entity.target_value
+            if entity.get_difference() == 0:
+                entity.predicted_value += direction
+                derivative += entity.get_mape_addition_derivative()
+    return difference
+
+
+def entity_optimal_multiplier(target_values, predicted_values, multipliers):
+    """Reference per-entity implementation of train.get_optimal_multiplier."""
+    entities = [Entity(target_value, predicted_value, multiplier)
+                for target_value, predicted_value, multiplier in zip(target_values, predicted_values, multipliers)]
+    entities.sort(key=lambda entity: entity.get_coefficient())
+    derivative = sum([entity.get_mape_multiplier_derivative(1) for entity in entities])
+    coefficient = 1
+    direction = 1
+    if derivative < 0:
+        direction = -1
+        entities.reverse()
+    if derivative != 0:
+        for entity in entities:
+            if derivative * direction < 0:
+                break
+            if entity.get_coefficient() * direction > 1 * direction:
+                coefficient = entity.get_coefficient()
+                derivative -= entity.get_mape_multiplier_derivative(1)
+                entity.predicted_value = entity.target_value
+                entity.multiplier *= coefficient
+            if entity.get_coefficient() == 1:
+                entity.predicted_value *= 2
+                derivative += entity.get_mape_multiplier_derivative(coefficient * 2) * direction
+    return coefficient
+
+
+def random_instances(generator: np.random.Generator):
+    size = int(generator.integers(0, 60))
+    target_values = generator.integers(100, 20000, size).astype(np.float64)
+    predicted_values = target_values * generator.uniform(0.3, 2.0, size) - generator.uniform(0, 500, size)
+    # Exact predictions and repeated values exercise ties and zero differences
+    exact = generator.random(size) < 0.2
+    predicted_values[exact] = target_values[exact]
+    repeated = generator.random(size) < 0.2
+    if size > 0:
+        predicted_values[repeated] = predicted_values[0]
+    multipliers = generator.choice([1.0, 0.5, 1.25, 2.0], size) * generator.uniform(0.8, 1.2, size)
+    return target_values, predicted_values, multipliers
+
+
+def check(cases, seed):
+    generator = np.random.default_rng(seed)
+    mismatches = 0
+    for case in range(cases):
+        instances = random_instances(generator)
+        for name, solver, reference in [('addition', get_optimal_addition, entity_optimal_addition),
+                                        ('multiplier', get_optimal_multiplier, entity_optimal_multiplier)]:
+            value = solver(*instances)
+            expected = reference(*instances)
+            if value != expected:
+                mismatches += 1
+                print(f'Case #{case} {name}: {value} instead of {expected}')
+    print(f'{mismatches} mismatches in {cases * 2} solutions')
+    return mismatches
+
+
+def main(argv):
+    cases = 1000
+    seed = 0
+    help_message = ' [-n <cases_count> -s <random_seed>]'
+    try:
+        opts, args = getopt.getopt(argv, "hn:s:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-n":
+            cases = int(arg)
+        elif opt == "-s":
+            seed = int(arg)
+    if check(cases, seed) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,54 @@
+import getopt
+import re
+import sys
+
+from model_file import read_factors, read_header, save_model
+
+
+def convert(input_model_path, output_model_path, error=None):
+    header = read_header(input_model_path)
+    bins = None
+    if header is not None:
+        print(f'{input_model_path} is already compiled')
+        # Bin edges and the error are kept, factors of binned columns are bin numbers
+        bins = header.get('bins')
+        if error is None:
+            error = header.get('error')
+    [additions, multipliers] = read_factors(input_model_path)
+    if error is None:
+        # Checkpoints are named <unix time>_<training error>.npy
+        match = re.search(r'_(\d+(?:\.\d+)?)\.npy$', input_model_path)
+        if match is not None:
+            error = float(match.group(1))
+    save_model(output_model_path, additions, multipliers, error, bins)
+
+
+def main(argv):
+    input_file = None
+    output_file = None
+    help_message = ' -i <input_model_path> -o <output_model_path>'
+    try:
+        opts, args = getopt.getopt(argv, "hi:o:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-i":
+            input_file = arg
+        elif opt == "-o":
+            output_file = arg
+    if input_file is not None and output_file is not None:
+        convert(input_file, output_file)
+    else:
+        if input_file is None:
+            print("Wrong -i")
+        if output_file is None:
+            print("Wrong -o")
+        print(help_message)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
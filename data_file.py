@@ -0,0 +1,154 @@
+"""Data files in the format chosen by their extension.
+
+``.parquet`` and ``.pq`` files are Parquet, ``.feather``, ``.arrow`` and ``.ipc`` files are Arrow IPC
+(Feather v2), any other file is CSV with the index in its first column. Parquet and Arrow files keep
+the column types and the index, so nothing is re-inferred on reading, and text columns are written
+as dictionary-encoded categoricals. Both need pyarrow, which is imported only when such a file is used.
+"""
+import os
+
+import pandas
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.feather', '.arrow', '.ipc')
+
+
+def file_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if extension in ARROW_EXTENSIONS:
+        return 'arrow'
+    return 'csv'
+
+
+def categorize(data):
+    """Returns the frame with text columns converted to categoricals."""
+    text_columns = [column for column, dtype in data.dtypes.items()
+                    if not isinstance(dtype, pandas.CategoricalDtype)
+                    and (dtype == object or pandas.api.types.is_string_dtype(dtype))]
+    if not text_columns:
+        return data
+    return data.astype({column: 'category' for column in text_columns})
+
+
+def _arrow_schema(path):
+    if file_format(path) == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(path)
+    import pyarrow.ipc
+    with pyarrow.memory_map(path) as source:
+        return pyarrow.ipc.open_file(source).schema
+
+
+def _index_columns(schema):
+    metadata = schema.pandas_metadata or {}
+    return [column for column in metadata.get('index_columns', []) if isinstance(column, str)]
+
+
+def read_columns(path):
+    """Returns the names of the data columns without reading the data."""
+    if file_format(path) == 'csv':
+        return list(pandas.read_csv(path, index_col=0, nrows=0).columns)
+    schema = _arrow_schema(path)
+    index_columns = _index_columns(schema)
+    return [name for name in schema.names if name not in index_columns]
+
+
+def _csv_columns(path, columns):
+    index_name = pandas.read_csv(path, nrows=0).columns[0]
+    return [index_name] + [column for column in columns if column != index_name]
+
+
+def read_table(path, columns: list = None):
+    """Reads the frame, only the given columns (and the index) when columns are given."""
+    file_type = file_format(path)
+    if file_type == 'csv':
+        usecols = None if columns is None else _csv_columns(path, columns)
+        return pandas.read_csv(path, index_col=0, usecols=usecols)
+    if file_type == 'parquet':
+        return pandas.read_parquet(path, columns=columns)
+    import pyarrow.feather
+    if columns is not None:
+        columns = _index_columns(_arrow_schema(path)) + list(columns)
+    return pyarrow.feather.read_table(path, columns=columns).to_pandas()
+
+
+def read_table_chunks(path, chunk_size: int, columns: list = None):
+    """Yields the frame by chunks of at most chunk_size rows."""
+    file_type = file_format(path)
+    if file_type == 'csv':
+        usecols = None if columns is None else _csv_columns(path, columns)
+        yield from pandas.read_csv(path, index_col=0, usecols=usecols, chunksize=chunk_size)
+        return
+    import pyarrow
+    if columns is not None:
+        columns = _index_columns(_arrow_schema(path)) + list(columns)
+    if file_type == 'parquet':
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield pyarrow.Table.from_batches([batch]).to_pandas()
+        return
+    import pyarrow.ipc
+    with pyarrow.memory_map(path) as source:
+        reader = pyarrow.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            if columns is not None:
+                batch = batch.select(columns)
+            for start in range(0, batch.num_rows, chunk_size):
+                yield pyarrow.Table.from_batches([batch.slice(start, chunk_size)]).to_pandas()
+
+
+def write_table(data, path):
+    """Writes the frame with its index; text columns are stored as categoricals in Parquet and Arrow files."""
+    file_type = file_format(path)
+    if file_type == 'csv':
+        data.to_csv(path)
+    elif file_type == 'parquet':
+        categorize(data).to_parquet(path)
+    else:
+        import pyarrow.feather
+        pyarrow.feather.write_feather(pyarrow.Table.from_pandas(categorize(data)), path)
+
+
+class TableWriter:
+    """Appends frames with the same columns to one file of any format."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file_type = file_format(path)
+        self._writer = None
+        self._sink = None
+        self._first = True
+
+    def write(self, data):
+        if self.file_type == 'csv':
+            data.to_csv(self.path, mode='w' if self._first else 'a', header=self._first)
+            self._first = False
+            return
+        import pyarrow
+        table = pyarrow.Table.from_pandas(data)
+        if self._writer is None:
+            if self.file_type == 'parquet':
+                import pyarrow.parquet
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            else:
+                import pyarrow.ipc
+                self._sink = pyarrow.OSFile(self.path, 'wb')
+                self._writer = pyarrow.ipc.new_file(self._sink, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
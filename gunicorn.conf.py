@@ -0,0 +1,52 @@
+"""Production server configuration: gunicorn -c gunicorn.conf.py app:app
+
+The application and model.npy are loaded in the master process before the workers are forked, so
+the workers share the loaded model copy-on-write. The master watches the model file and, when it
+changes, reloads the model and gracefully replaces the workers (the same as sending SIGHUP).
+"""
+import os
+import signal
+import threading
+from time import sleep
+
+bind = f'0.0.0.0:{os.environ.get("PORT", 5000)}'
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+preload_app = True
+graceful_timeout = 30
+model_check_interval = float(os.environ.get('MODEL_CHECK_INTERVAL', 5))
+
+
+def _load_model(server):
+    from app import models
+    try:
+        model = models.get()
+    except FileNotFoundError:
+        server.log.warning('%s is not found, workers will load it when available', models.filename)
+        return
+    server.log.info('Serving %s version %s', models.filename, model.version)
+
+
+def _watch_model(server):
+    from app import models
+    while True:
+        sleep(model_check_interval)
+        try:
+            signature = models._signature()
+        except FileNotFoundError:
+            continue
+        if models.model is None or models.model.signature != signature:
+            server.log.info('%s changed, reloading workers', models.filename)
+            os.kill(os.getpid(), signal.SIGHUP)
+            sleep(graceful_timeout)
+
+
+def when_ready(server):
+    _load_model(server)
+    if model_check_interval > 0:
+        threading.Thread(target=_watch_model, args=(server,), daemon=True).start()
+
+
+def on_reload(server):
+    _load_model(server)
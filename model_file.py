@@ -0,0 +1,120 @@
+"""Compiled model file.
+
+The file is a regular ``.npy`` float64 matrix of shape (2, factors count): the first row holds the
+additions and the second row holds the multipliers of all factors, column after column. The matrix is
+followed by a JSON header (format version, training error, the factors vocabulary of every column and,
+since format 2, the inner bin edges of binned columns, see binning.py), the header length and the
+``MAGIC`` marker. ``numpy.load`` reads the matrix and ignores the trailing header.
+
+Models saved before this format are pickled ``[additions, multipliers]`` lists; ``read_factors`` and
+``load_model`` still accept them.
+"""
+import json
+import math
+import struct
+from time import time
+
+import numpy
+
+FORMAT_VERSION = 2
+MAGIC = b'CARMODEL'
+_TRAILER = struct.Struct('<Q8s')
+
+
+def _plain(factor):
+    return factor.item() if isinstance(factor, numpy.generic) else factor
+
+
+def _is_nan(factor):
+    return isinstance(factor, float) and math.isnan(factor)
+
+
+def compile_factors(additions: dict, multipliers: dict):
+    """Flattens nested factors dicts to per-column vocabularies and a (2, factors count) matrix.
+
+    NaN factors are dropped: they never match at prediction time.
+    """
+    columns = list(additions) + [column for column in multipliers if column not in additions]
+    vocabularies = {}
+    for column in columns:
+        factors = list(additions.get(column, {}))
+        factors += [factor for factor in multipliers.get(column, {}) if factor not in additions.get(column, {})]
+        vocabularies[column] = [factor for factor in factors if not _is_nan(factor)]
+    size = sum(len(factors) for factors in vocabularies.values())
+    values = numpy.empty((2, size), dtype=numpy.float64)
+    position = 0
+    for column, factors in vocabularies.items():
+        column_additions = additions.get(column, {})
+        column_multipliers = multipliers.get(column, {})
+        for factor in factors:
+            values[0, position] = column_additions.get(factor, 0.0)
+            values[1, position] = column_multipliers.get(factor, 1.0)
+            position += 1
+    return vocabularies, values
+
+
+def save_model(path, additions: dict, multipliers: dict, error=None, bins: dict = None):
+    vocabularies, values = compile_factors(additions, multipliers)
+    header = {'format': FORMAT_VERSION,
+              'created': int(time()),
+              'error': None if error is None else float(error),
+              'columns': [{'name': column, 'factors': [_plain(factor) for factor in factors]}
+                          for column, factors in vocabularies.items()],
+              'bins': {column: [float(edge) for edge in edges] for column, edges in (bins or {}).items()}}
+    encoded_header = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    with open(path, 'wb') as file:
+        numpy.lib.format.write_array(file, values, allow_pickle=False)
+        file.write(encoded_header)
+        file.write(_TRAILER.pack(len(encoded_header), MAGIC))
+
+
+def read_header(path):
+    """Returns the JSON header of a compiled model or None for a legacy pickled model."""
+    with open(path, 'rb') as file:
+        file.seek(0, 2)
+        if file.tell() < _TRAILER.size:
+            return None
+        file.seek(-_TRAILER.size, 2)
+        length, magic = _TRAILER.unpack(file.read(_TRAILER.size))
+        if magic != MAGIC:
+            return None
+        file.seek(-_TRAILER.size - length, 2)
+        return json.loads(file.read(length).decode('utf-8'))
+
+
+def load_model(path, mmap_mode=None):
+    """Returns (header, vocabularies, values) where values is the (2, factors count) matrix.
+
+    Values are read into memory unless mmap_mode is given: a map of a file that is rewritten in place,
+    e.g. by copying another model over it, would fault on access once the file is truncated.
+    Legacy pickled models are compiled in memory and get a header with ``format`` 0.
+    """
+    header = read_header(path)
+    if header is None:
+        additions, multipliers = numpy.load(path, allow_pickle=True)
+        vocabularies, values = compile_factors(additions, multipliers)
+        return {'format': 0, 'error': None, 'bins': {}}, vocabularies, values
+    header.setdefault('bins', {})
+    values = numpy.load(path, mmap_mode=mmap_mode)
+    vocabularies = {column['name']: column['factors'] for column in header['columns']}
+    return header, vocabularies, values
+
+
+def read_factors(path):
+    """Returns [additions, multipliers] nested dicts of a model in any format."""
+    header = read_header(path)
+    if header is None:
+        additions, multipliers = numpy.load(path, allow_pickle=True)
+        return [additions, multipliers]
+    values = numpy.load(path)
+    additions = {}
+    multipliers = {}
+    position = 0
+    for column in header['columns']:
+        additions[column['name']] = {}
+        multipliers[column['name']] = {}
+        for factor in column['factors']:
+            additions[column['name']][factor] = float(values[0, position])
+            multipliers[column['name']][factor] = float(values[1, position])
+            position += 1
+    return [additions, multipliers]
@@ -0,0 +1,119 @@
+import getopt
+import os
+import sys
+from contextlib import contextmanager
+from time import perf_counter
+
+from app import LoadingPredictor
+from binning import parse_bins
+from check import mean_absolute_percentage_error
+from data_file import read_table, write_table
+from prepare import blacklist, prepare_data
+from split import split_data
+from train import TrainingPredictor, default_ignore
+
+
+def run_pipeline(data_path, target: str, artifacts_directory: str = None, artifacts_extension='csv',
+                 bins: dict = None, **training_kwargs):
+    """Runs prepare, split, train, predict and check in one process on in-memory frames.
+
+    Intermediate frames are written to artifacts_directory only when it is given, with the same names
+    the separate scripts use. Returns the path of the trained model, its validation error and the
+    seconds spent in every stage.
+    """
+    timings = {}
+
+    @contextmanager
+    def stage(name):
+        start = perf_counter()
+        yield
+        timings[name] = timings.get(name, 0.0) + perf_counter() - start
+        print(f'Stage {name} took {timings[name]:.2f} s', flush=True)
+
+    def write(data, name):
+        if artifacts_directory is not None:
+            with stage('write'):
+                write_table(data, os.path.join(artifacts_directory, f'{name}.{artifacts_extension}'))
+
+    if artifacts_directory is not None:
+        os.makedirs(artifacts_directory, exist_ok=True)
+    with stage('read'):
+        data = read_table(data_path)
+    with stage('prepare'):
+        prepared = prepare_data(data, ignore_columns=blacklist)
+    write(prepared, 'prepared_train')
+    with stage('split'):
+        training, validating = split_data(prepared, target)
+    write(training, 'training')
+    write(validating, 'validating')
+    with stage('train'):
+        predictor = TrainingPredictor(training, target, bins=bins)
+        model_path = predictor.train(ignore=default_ignore(), **training_kwargs)
+    with stage('predict'):
+        prices = LoadingPredictor(model_path, []).predict_target_values(validating)
+    write(validating[[]].assign(Predicted=prices).rename_axis('Id'), 'predicted_validating_targets')
+    with stage('check'):
+        error = mean_absolute_percentage_error(validating[target].values, prices)
+    print(f'{error}% error validation')
+    print('\n'.join(f'{name:>8}: {seconds:.2f} s' for name, seconds in timings.items()))
+    print(f'{"total":>8}: {sum(timings.values()):.2f} s', flush=True)
+    return model_path, error, timings
+
+
+def main(argv):
+    input_file = None
+    target = None
+    kwargs = {}
+    help_message = ' -i <input_data_path> -g <target> [-t <iterations_count> -s <save_period>' \
+                   ' -m <models_directory> -a <artifacts_directory> -e <artifacts_extension>' \
+                   ' --workers <processes_count> --tolerance <relative_improvement> --patience <iterations_count>' \
+                   ' --track-changes <relative_change> --timing-log <jsonl_path>' \
+                   ' --bins <column:quantile|width:count,...>]'
+    try:
+        opts, args = getopt.getopt(argv, "hi:g:t:s:m:a:e:", ["workers=", "tolerance=", "patience=", "track-changes=",
+                                                             "timing-log=", "bins="])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-i":
+            input_file = arg
+        elif opt == "-g":
+            target = arg
+        elif opt == "-t":
+            kwargs["times"] = int(arg)
+        elif opt == "-s":
+            kwargs["save_period"] = int(arg)
+        elif opt == "-m":
+            kwargs["models_directory"] = arg
+        elif opt == "-a":
+            kwargs["artifacts_directory"] = arg
+        elif opt == "-e":
+            kwargs["artifacts_extension"] = arg
+        elif opt == "--workers":
+            kwargs["workers"] = int(arg)
+        elif opt == "--tolerance":
+            kwargs["tolerance"] = float(arg)
+        elif opt == "--patience":
+            kwargs["patience"] = int(arg)
+        elif opt == "--track-changes":
+            kwargs["change_threshold"] = float(arg)
+        elif opt == "--timing-log":
+            kwargs["timing_log_path"] = arg
+        elif opt == "--bins":
+            kwargs["bins"] = parse_bins(arg)
+    if input_file is not None and target is not None:
+        run_pipeline(input_file, target, **kwargs)
+    else:
+        if input_file is None:
+            print("Wrong -i")
+        if target is None:
+            print("Wrong -g")
+        print(help_message)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,116 @@
+import getopt
+import sys
+from collections import deque
+from multiprocessing import Pool
+from time import time
+
+from pandas import DataFrame
+
+from app import CONTINUOUS_TERMS, LoadingPredictor
+from data_file import TableWriter, read_columns, read_table_chunks
+from model_file import read_header
+
+_worker_predictor = None
+
+
+def _init_worker(model_path):
+    global _worker_predictor
+    _worker_predictor = LoadingPredictor(model_path, [])
+
+
+def _predict_chunk(chunk):
+    return _worker_predictor.predict_target_values(chunk)
+
+
+def _model_columns(model_path, data_path):
+    """Returns the data columns the model uses, None for a legacy model without a header."""
+    header = read_header(model_path)
+    if header is None:
+        return None
+    used = {column['name'] for column in header['columns']} | set(CONTINUOUS_TERMS)
+    return [column for column in read_columns(data_path) if column in used]
+
+
+def stream_predict(model_path, data_path, prediction_path, chunk_size=100000, workers=1,
+                   column_name='Predicted', index_name='Id', progress=None):
+    """Scores the data file chunk by chunk and appends prices to the prediction file.
+
+    Only the columns the model uses are read. At most chunk_size rows are held per chunk; with
+    several workers at most two chunks per worker are in flight, and results are written in input
+    order. When progress is given, it is called with the number of written rows after every chunk
+    instead of printing the progress.
+    """
+    start = time()
+    rows_count = 0
+    writer = TableWriter(prediction_path)
+
+    def write(chunk, prices):
+        nonlocal rows_count
+        writer.write(DataFrame(prices, index=chunk.index, columns=[column_name]).rename_axis(index_name))
+        rows_count += len(chunk)
+        if progress is not None:
+            progress(rows_count)
+            return
+        elapsed = time() - start
+        print(f'\rPredicted {rows_count} rows in {elapsed:.1f} s ({rows_count / max(elapsed, 1e-9):.0f} rows/s)',
+              end='', flush=True)
+
+    chunks = read_table_chunks(data_path, chunk_size, columns=_model_columns(model_path, data_path))
+    with writer:
+        if workers > 1:
+            with Pool(workers, initializer=_init_worker, initargs=(model_path,)) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append((chunk, pool.apply_async(_predict_chunk, (chunk,))))
+                    if len(pending) >= workers * 2:
+                        done_chunk, result = pending.popleft()
+                        write(done_chunk, result.get())
+                while pending:
+                    done_chunk, result = pending.popleft()
+                    write(done_chunk, result.get())
+        else:
+            predictor = LoadingPredictor(model_path, [])
+            for chunk in chunks:
+                write(chunk, predictor.predict_target_values(chunk))
+    if progress is None:
+        print()
+
+
+def main(argv):
+    input_file = None
+    output_file = None
+    model_file = 'model.npy'
+    kwargs = {}
+    help_message = ' -i <input_data_path> -o <output_prediction_path> [-m <model_path>' \
+                   ' -c <chunk_rows_count> -w <workers_count>]'
+    try:
+        opts, args = getopt.getopt(argv, "hi:o:m:c:w:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-i":
+            input_file = arg
+        elif opt == "-o":
+            output_file = arg
+        elif opt == "-m":
+            model_file = arg
+        elif opt == "-c":
+            kwargs["chunk_size"] = int(arg)
+        elif opt == "-w":
+            kwargs["workers"] = int(arg)
+    if input_file is not None and output_file is not None:
+        stream_predict(model_file, input_file, output_file, **kwargs)
+    else:
+        if input_file is None:
+            print("Wrong -i")
+        if output_file is None:
+            print("Wrong -o")
+        print(help_message)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,17 +1,20 @@
 import getopt
 import sys
 
-import pandas
+from data_file import read_columns, read_table, write_table
 
 
-def prepare(data_path, output_path, ignore_columns=None):
-    data = pandas.read_csv(data_path, index_col=0)
+def prepare_data(data, ignore_columns=None):
     data = data.drop(columns=set(ignore_columns).intersection(data.columns))
     first_columns = [column
                      for column in ['insurance_price', 'registration_year', 'engine_capacity', 'model']
                      if column not in ignore_columns]
-    data = data[first_columns + [column for column in data.columns if column not in first_columns]]
-    data.to_csv(output_path)
+    return data[first_columns + [column for column in data.columns if column not in first_columns]]
+
+
+def prepare(data_path, output_path, ignore_columns=None):
+    columns = [column for column in read_columns(data_path) if column not in ignore_columns]
+    write_table(prepare_data(read_table(data_path, columns=columns), ignore_columns), output_path)
 
 
 blacklist = ['engine_capacity', 'zipcode']
@@ -1,16 +1,21 @@
 import getopt
 import sys
 
-import pandas
+from data_file import read_table, write_table
 
 
-def split(input_data_path, output_train_data_path, output_valid_data_path, target: str):
-    data = pandas.read_csv(input_data_path, index_col=0)
+def split_data(data, target: str):
+    """Returns (training, validating) frames, every fifth row by index goes to validating."""
     data = data.sort_values(target)
     validating = data.iloc[lambda x: x.index % 5 == 0]
-    validating.to_csv(output_valid_data_path)
     training = data.iloc[lambda x: x.index % 5 != 0]
-    training.to_csv(output_train_data_path)
+    return training, validating
+
+
+def split(input_data_path, output_train_data_path, output_valid_data_path, target: str):
+    training, validating = split_data(read_table(input_data_path), target)
+    write_table(validating, output_valid_data_path)
+    write_table(training, output_train_data_path)
 
 
 def main(argv):
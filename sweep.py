@@ -0,0 +1,126 @@
+import contextlib
+import getopt
+import io
+import itertools
+import json
+import sys
+from multiprocessing import Pool
+from time import perf_counter
+
+import numpy
+from pandas import DataFrame
+
+from data_file import write_table
+from train import TrainingPredictor, default_ignore
+
+_worker_state = {}
+
+
+def _init_worker(encoded, data, target):
+    # With fork the encoded data is inherited, so every worker shares one copy-on-write copy of it
+    _worker_state.update(encoded=encoded, data=data, target=target)
+
+
+def _run(task):
+    """Trains one configuration on one fold and returns its errors and timing."""
+    configuration_index, configuration, fold, folds = task
+    encoded, data, target = _worker_state['encoded'], _worker_state['data'], _worker_state['target']
+    held_out = numpy.asarray(data.index % folds == fold)
+    start = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        predictor = encoded.subset(numpy.flatnonzero(~held_out), configuration['rarity_ignore'])
+        predictor.train(times=configuration['times'], ignore=configuration['ignore'], models_directory=None)
+    training_error = predictor.find_prediction_error()
+    validation = data[held_out]
+    error = predictor.find_prediction_error(validation.drop(columns=[target]), validation[target].to_numpy())
+    return configuration_index, fold, training_error, error, perf_counter() - start
+
+
+def configurations(grid: dict):
+    """Expands the grid to configurations: every combination of rarity_ignore, ignore and times values."""
+    ignore_presets = grid.get('ignore', {'default': default_ignore()})
+    combinations = itertools.product(grid.get('rarity_ignore', [0.0]), ignore_presets.items(), grid.get('times', [5]))
+    return [{'rarity_ignore': rarity_ignore, 'ignore_name': name, 'ignore': ignore, 'times': times}
+            for rarity_ignore, (name, ignore), times in combinations]
+
+
+def sweep(data_path, target: str, grid: dict, folds=5, workers=1):
+    """Trains every configuration of the grid on k folds and returns the leaderboard sorted by MAPE.
+
+    The data is read and factorized once; fold predictors are built from the shared codes.
+    Fold i holds out rows whose index modulo k is i, so with k=5 fold 0 is split.py's validating set.
+    """
+    start = perf_counter()
+    encoded = TrainingPredictor(data_path, target)
+    data = encoded.read_data(data_path)
+    print(f'Encoded once in {perf_counter() - start:.2f} s', flush=True)
+    runs = configurations(grid)
+    tasks = [(index, configuration, fold, folds) for index, configuration in enumerate(runs) for fold in range(folds)]
+    results = {index: [] for index in range(len(runs))}
+    with Pool(workers, initializer=_init_worker, initargs=(encoded, data, target)) as pool:
+        for index, fold, training_error, error, seconds in pool.imap_unordered(_run, tasks):
+            results[index].append((training_error, error, seconds))
+            print(f'Configuration #{index} fold {fold}: {error}% error in {seconds:.2f} s', flush=True)
+    leaderboard = DataFrame([{'rarity_ignore': configuration['rarity_ignore'],
+                              'ignore': configuration['ignore_name'],
+                              'times': configuration['times'],
+                              'mape': numpy.mean([error for _, error, _ in results[index]]),
+                              'mape_std': numpy.std([error for _, error, _ in results[index]]),
+                              'training_mape': numpy.mean([error for error, _, _ in results[index]]),
+                              'seconds_per_fold': numpy.mean([seconds for _, _, seconds in results[index]])}
+                             for index, configuration in enumerate(runs)])
+    leaderboard = leaderboard.sort_values('mape', ignore_index=True).rename_axis('rank')
+    print(f'Sweep of {len(tasks)} runs took {perf_counter() - start:.2f} s', flush=True)
+    return leaderboard
+
+
+def main(argv):
+    input_file = None
+    target = None
+    grid = {}
+    output_file = None
+    kwargs = {}
+    help_message = ' -i <input_data_path> -g <target> [-k <folds_count> -w <workers_count>' \
+                   ' -c <grid_json_path> -r <comma_separated_rarity_ignore> -t <comma_separated_iterations_counts>' \
+                   ' -o <leaderboard_path>]'
+    try:
+        opts, args = getopt.getopt(argv, "hi:g:k:w:c:r:t:o:", [])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_message)
+            sys.exit()
+        elif opt == "-i":
+            input_file = arg
+        elif opt == "-g":
+            target = arg
+        elif opt == "-k":
+            kwargs["folds"] = int(arg)
+        elif opt == "-w":
+            kwargs["workers"] = int(arg)
+        elif opt == "-c":
+            with open(arg) as file:
+                grid.update(json.load(file))
+        elif opt == "-r":
+            grid["rarity_ignore"] = [float(value) for value in arg.split(',')]
+        elif opt == "-t":
+            grid["times"] = [int(value) for value in arg.split(',')]
+        elif opt == "-o":
+            output_file = arg
+    if input_file is not None and target is not None:
+        leaderboard = sweep(input_file, target, grid, **kwargs)
+        print(leaderboard.to_string())
+        if output_file is not None:
+            write_table(leaderboard, output_file)
+    else:
+        if input_file is None:
+            print("Wrong -i")
+        if target is None:
+            print("Wrong -g")
+        print(help_message)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,16 +1,19 @@
-import math
-from collections import defaultdict, Counter
-from time import time
+from multiprocessing import Pool, shared_memory
+from time import perf_counter, time
 import getopt
+import hashlib
+import json
+import os
 import sys
+import tempfile
 import pandas
 import numpy as np
 
 from pandas import notnull
 
-
-def sign(x):
-    return x and (-1 if x < 0 else 1)
+from binning import bucketize, fit_bins, parse_bins
+from data_file import read_table
+from model_file import read_factors, read_header, save_model
 
 
 class Predictor:
@@ -21,7 +24,8 @@ class Predictor:
 
     @staticmethod
     def read_data(data_path):
-        dataFrame = pandas.read_csv(data_path, index_col=0)
+        """Reads the data file; a frame that is already in memory is taken as it is."""
+        dataFrame = data_path if isinstance(data_path, pandas.DataFrame) else read_table(data_path)
         return dataFrame.where(notnull(dataFrame), None)
 
     def predict_target_value(self, car):
@@ -43,96 +47,513 @@ class Predictor:
                     index, instance in data.iterrows()]
 
 
-class Entity:
-    def __init__(self, target_value, predicted_value, multiplier):
-        self.target_value = target_value
-        self.predicted_value = predicted_value
-        self.multiplier = multiplier
-
-    def get_difference(self):
-        return (self.target_value - self.predicted_value) / self.multiplier
-
-    def get_coefficient(self):
-        return self.target_value / self.predicted_value
-
-    def get_mape_addition_derivative(self):
-        return self.multiplier * sign(self.get_difference()) / self.target_value
-
-    def get_mape_multiplier_derivative(self, current_factor_multiplier):
-        return self.predicted_value / current_factor_multiplier * sign(self.get_difference()) / self.target_value
+def signs(values):
+    """Sign of every value as -1.0, 0.0 or 1.0; NaN counts as positive."""
+    return np.where(values < 0, -1.0, np.where(values == 0, 0.0, 1.0))
+
+
+def _count_processed(derivatives, direction):
+    """Returns how many instances are walked before the derivative changes its sign."""
+    stops = np.flatnonzero(derivatives[:-1] * direction < 0)
+    return stops[0] if len(stops) > 0 else len(derivatives) - 1
+
+
+def _accumulate(derivative, removed, added):
+    """Returns the derivative before every instance and after the last one.
+
+    Terms are accumulated one by one in walk order, so the values match a sequential loop.
+    """
+    steps = np.empty(2 * len(removed) + 1)
+    steps[0] = derivative
+    steps[1::2] = -removed
+    steps[2::2] = added
+    return np.cumsum(steps)[0::2]
+
+
+def get_optimal_addition(target_values, predicted_values, multipliers):
+    """Returns the addition of a factor that minimizes MAPE of its instances.
+
+    It is the weighted median of the differences (target - predicted) / multiplier with weights
+    multiplier / target: instances are walked from the side the MAPE derivative points to until
+    the derivative changes its sign.
+    """
+    if len(target_values) == 0:
+        return 0
+    differences = (target_values - predicted_values) / multipliers
+    order = np.argsort(differences, kind='stable')
+    targets, predicted = target_values[order], predicted_values[order]
+    multipliers, differences = multipliers[order], differences[order]
+    weights = multipliers * signs(differences) / targets
+    derivative = np.cumsum(weights)[-1]
+    if derivative == 0:
+        return 0
+    direction = -1 if derivative < 0 else 1
+    if direction < 0:
+        targets, predicted, multipliers = targets[::-1], predicted[::-1], multipliers[::-1]
+        differences, weights = differences[::-1], weights[::-1]
+    passed = differences * direction > 0
+    # A passed instance is predicted exactly and then, like an exact one, moved one step further
+    moved = np.where(passed, targets, predicted)
+    exact = (targets - moved) / multipliers == 0
+    moved = np.where(exact, moved + direction, moved)
+    added = np.where(exact, multipliers * signs((targets - moved) / multipliers) / targets, 0.0)
+    derivatives = _accumulate(derivative, np.where(passed, weights, 0.0), added)
+    hits = np.flatnonzero(passed[:_count_processed(derivatives, direction)])
+    return differences[hits[-1]] if len(hits) > 0 else 0
+
+
+def get_optimal_multiplier(target_values, predicted_values, multipliers):
+    """Returns the multiplier of a factor that minimizes MAPE of its instances.
+
+    It is the weighted median of the coefficients target / predicted with weights
+    predicted / target, found the same way as in get_optimal_addition.
+    """
+    if len(target_values) == 0:
+        return 1
+    coefficients = target_values / predicted_values
+    order = np.argsort(coefficients, kind='stable')
+    targets, predicted = target_values[order], predicted_values[order]
+    multipliers, coefficients = multipliers[order], coefficients[order]
+    weights = predicted * signs((targets - predicted) / multipliers) / targets
+    derivative = np.cumsum(weights)[-1]
+    if derivative == 0:
+        return 1
+    direction = -1 if derivative < 0 else 1
+    if direction < 0:
+        targets, predicted, multipliers = targets[::-1], predicted[::-1], multipliers[::-1]
+        coefficients, weights = coefficients[::-1], weights[::-1]
+    passed = coefficients * direction > direction
+    indexes = np.maximum.accumulate(np.where(passed, np.arange(len(passed)), -1))
+    current_coefficients = np.where(indexes >= 0, coefficients[indexes], 1)
+    moved = np.where(passed, targets, predicted)
+    multipliers = np.where(passed, multipliers * coefficients, multipliers)
+    exact = targets / moved == 1
+    moved = np.where(exact, moved * 2, moved)
+    added = np.where(exact, moved / (current_coefficients * 2) * signs((targets - moved) / multipliers) / targets
+                     * direction, 0.0)
+    derivatives = _accumulate(derivative, np.where(passed, weights, 0.0), added)
+    hits = np.flatnonzero(passed[:_count_processed(derivatives, direction)])
+    return coefficients[hits[-1]] if len(hits) > 0 else 1
+
+
+_worker_state = {}
+
+
+def _init_worker(memory_name, rows_count, instances):
+    memory = shared_memory.SharedMemory(name=memory_name)
+    _worker_state['memory'] = memory
+    _worker_state['arrays'] = np.ndarray((3, rows_count), dtype=np.float64, buffer=memory.buf)
+    _worker_state['instances'] = instances
+
+
+def _solve_factors(task):
+    kind, column, positions = task
+    target_values, current_targets, instance_multipliers = _worker_state['arrays']
+    offsets, indexes = _worker_state['instances'][column]
+    solver = get_optimal_addition if kind == 'additions' else get_optimal_multiplier
+    values = []
+    for position in positions:
+        instances = indexes[offsets[position]:offsets[position + 1]]
+        values.append(solver(target_values[instances], current_targets[instances], instance_multipliers[instances]))
+    return values
+
+
+class ColumnSolverPool:
+    """Process pool that solves all factors of one column in parallel.
+
+    Factors of a column have disjoint instances and read the same snapshot of targets, so they
+    are independent. Targets, current targets and instance multipliers are shared with workers
+    through shared memory; every task gets a part of the factor positions and returns their values
+    in order, so the merged result does not depend on scheduling.
+    """
+
+    def __init__(self, predictor, workers: int):
+        rows_count = len(predictor.target_values)
+        self._memory = shared_memory.SharedMemory(create=True, size=max(3 * rows_count * 8, 1))
+        self._arrays = np.ndarray((3, rows_count), dtype=np.float64, buffer=self._memory.buf)
+        self._arrays[0] = predictor.target_values
+        self._instances = predictor.instances
+        self._workers = workers
+        self._pool = Pool(workers, initializer=_init_worker,
+                          initargs=(self._memory.name, rows_count, predictor.instances))
+
+    def solve(self, kind, column, current_targets, instance_multipliers, positions):
+        """Returns optimal values of the column factors at the given positions."""
+        if len(positions) == 0:
+            return []
+        self._arrays[1] = current_targets
+        self._arrays[2] = instance_multipliers
+        sizes = np.diff(self._instances[column][0])[positions]
+        # Round-robin over factors sorted by size gives tasks of similar cost
+        by_size = np.argsort(-sizes, kind='stable')
+        tasks_count = min(self._workers * 4, len(positions))
+        tasks = [by_size[task::tasks_count] for task in range(tasks_count)]
+        values = [None] * len(positions)
+        results = self._pool.map(_solve_factors, [(kind, column, positions[task].tolist()) for task in tasks])
+        for task, task_values in zip(tasks, results):
+            for index, value in zip(task, task_values):
+                values[index] = value
+        return values
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        del self._arrays
+        self._memory.close()
+        self._memory.unlink()
 
 
 class TrainingPredictor(Predictor):
-    def __init__(self, data_path, target_column, rarity_ignore: float = 0.0):
+    def __init__(self, data_path, target_column, rarity_ignore: float = 0.0, bins: dict = None,
+                 memmap_directory: str = None):
+        """Reads and encodes the training data.
+
+        bins maps continuous columns to (method, count): their values are replaced by bin numbers
+        fitted on this data (see binning.py) before the factors are built. With memmap_directory,
+        targets, codes and instances are written to .npy files there and memory-mapped from disk.
+        """
         super().__init__()
+        start = time()
         print('Extracting data...', flush=True)
         data = self.read_data(data_path)
         self.ignore = {'additions': [], 'multipliers': []}
-        self.target_values = data[target_column].to_numpy()
+        self.memmap_directory = memmap_directory
+        if memmap_directory is not None:
+            os.makedirs(memmap_directory, exist_ok=True)
+        self.target_values = self._store('target_values', data[target_column].to_numpy(dtype=np.float64))
         data_no_target = data.drop(columns=[target_column])
 
-        print('Setting default values for factors...', flush=True)
+        print('Encoding factors...', flush=True)
         minimum = len(data_no_target) * rarity_ignore
-        factors_instances_counter = {column: Counter(data_no_target[column]) for column in data_no_target}
-        self.additions = {column: {factor: 0.0
-                                   for factor in set(data_no_target[column]).union({None})
-                                   if factor is None or factors_instances_counter[column][factor] >= minimum}
-                          for column in data_no_target}
-        self.multipliers = {column: {factor: 1.0
-                                     for factor in set(data_no_target[column]).union({None})
-                                     if factor is None or factors_instances_counter[column][factor] >= minimum}
-                            for column in data_no_target}
-        for column in factors_instances_counter:
-            for item in factors_instances_counter[column]:
-                if factors_instances_counter[column][item] < minimum:
-                    data_no_target[column].replace({item: None}, inplace=True)
-
-        for column in self.additions:
-            print(f'{column} has {len(self.additions[column])} factors')
-
-        print('Evaluating instances with the same factor...', flush=True)
-        self.factors_instances = {}
+        self.bin_edges = {column: fit_bins(data_no_target[column], method, count)
+                          for column, (method, count) in (bins or {}).items() if column in data_no_target}
+        self.factors = {}
+        self.positions = {}
+        self.codes = {}
+        self.instances = {}
         for column in data_no_target:
-            column_values = data_no_target[column]
-            self.factors_instances[column] = defaultdict(list)
-            list_index = 0
-            for index, factor in column_values.items():
-                if not isinstance(factor, float) or not math.isnan(factor):
-                    self.factors_instances[column][factor] += [list_index]
-                list_index += 1
+            values = data_no_target[column]
+            if column in self.bin_edges:
+                values = bucketize(values, self.bin_edges[column])
+            self._encode_column(column, values, minimum)
+            print(f'{column} has {len(self.factors[column])} factors')
+        del data, data_no_target
+        self.additions = {column: {factor: 0.0 for factor in self.factors[column]} for column in self.factors}
+        self.multipliers = {column: {factor: 1.0 for factor in self.factors[column]} for column in self.factors}
+
+        self.solver_pool = None
+        self.change_threshold = None
+        self.solved_ratios = {}
+        self.delta_start = None
+        self.timing_log = None
+        self.iteration = 0
+        self.resumed = None
+        self.settings = None
+        self.addition_sums = None
+        self.instance_multipliers = None
+        self.current_targets = None
+        self.refresh_temporal_values()
+        state_size = sum(array.nbytes for array in self._state_arrays())
+        mapped_size = sum(array.nbytes for array in self._state_arrays() if isinstance(array, np.memmap))
+        print(f'Setup took {time() - start:.2f} s, training state uses {state_size / 2 ** 20:.1f} MiB'
+              f' ({mapped_size / 2 ** 20:.1f} MiB memory-mapped)', flush=True)
+
+    def _encode_column(self, column, values, minimum):
+        """Factorizes the column once and groups its rows by factor.
+
+        Missing (None or NaN) cells and values seen less than minimum times share the None factor, the
+        same one the service looks missing values up as. Codes of rows are int32 positions in
+        self.factors[column]; instances are stored CSR-style as int32 row indexes sorted by code with
+        per-factor offsets.
+        """
+        codes, uniques = pandas.factorize(values)
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        kept = counts >= minimum
+        factors = [factor for factor, keep in zip(uniques.tolist(), kept) if keep] + [None]
+        # Missing cells are coded -1 by factorize and pick the last entry, the None factor
+        remap = np.full(len(uniques) + 1, len(factors) - 1, dtype=np.int32)
+        remap[np.flatnonzero(kept)] = np.arange(len(factors) - 1)
+        self._set_column(column, factors, remap[codes])
+
+    def _set_column(self, column, factors: list, codes):
+        index = list(self.factors).index(column) if column in self.factors else len(self.factors)
+        codes = self._store(f'codes_{index}', codes.astype(np.int32, copy=False))
+        order = self._store(f'instances_{index}', np.argsort(codes, kind='stable').astype(np.int32))
+        offsets = np.searchsorted(codes[order], np.arange(len(factors) + 1))
+        self.factors[column] = factors
+        self.positions[column] = {factor: position for position, factor in enumerate(factors)}
+        self.codes[column] = codes
+        self.instances[column] = (offsets, order)
+
+    def _store(self, name, array):
+        """Returns the array, or its read-only memory map from a file of memmap_directory when it is set.
+
+        The file is replaced rather than rewritten, so maps of its previous contents stay valid.
+        """
+        if self.memmap_directory is None:
+            return array
+        with tempfile.NamedTemporaryFile(dir=self.memmap_directory, suffix='.npy', delete=False) as file:
+            np.save(file, array)
+        path = os.path.join(self.memmap_directory, f'{name}.npy')
+        os.replace(file.name, path)
+        return np.load(path, mmap_mode='r')
+
+    def _state_arrays(self):
+        yield self.target_values
+        yield self.addition_sums
+        yield self.instance_multipliers
+        yield self.current_targets
+        for column in self.codes:
+            yield self.codes[column]
+            yield from self.instances[column]
+
+    def get_factor_instances(self, column, factor):
+        """Returns indexes of the rows with the factor in the column."""
+        offsets, indexes = self.instances[column]
+        position = self.positions[column][factor]
+        return indexes[offsets[position]:offsets[position + 1]]
+
+    def _column_values(self, values: dict, column):
+        """Returns values of the column factors in position order."""
+        return np.array([values[column][factor] for factor in self.factors[column]], dtype=np.float64)
+
+    def _gather(self, values: dict, column, default, codes: dict = None):
+        """Returns the value of the column factor of every row, default for rows without a factor.
+
+        Rows without a factor are coded -1 and pick the default appended after the factors values.
+        """
+        column_values = np.append(self._column_values(values, column), default)
+        return column_values[(self.codes if codes is None else codes)[column]]
+
+    def _get_addition_sums(self, codes: dict = None):
+        codes = self.codes if codes is None else codes
+        sums = np.zeros(len(next(iter(codes.values()))))
+        for column in codes:
+            if column in self.additions:
+                sums += self._gather(self.additions, column, 0.0, codes)
+        return sums
+
+    def _get_multiplier_products(self, codes: dict = None):
+        codes = self.codes if codes is None else codes
+        products = np.ones(len(next(iter(codes.values()))))
+        for column in codes:
+            if column in self.multipliers:
+                products *= self._gather(self.multipliers, column, 1.0, codes)
+        return products
+
+    def _bucketize(self, column, values):
+        """Returns bin numbers in place of the values of a binned column, other columns as they are."""
+        return bucketize(values, self.bin_edges[column]) if column in self.bin_edges else values
+
+    def _encode_values(self, column, values):
+        """Returns codes of the (bucketized) values in the column factors: the None factor if missing, -1 if unknown."""
+        vocabulary = pandas.Index(self.factors[column], dtype=object)
+        if isinstance(values.dtype, pandas.CategoricalDtype):
+            codes = np.append(vocabulary.get_indexer(values.cat.categories), -1)[values.cat.codes.to_numpy()]
+        else:
+            codes = vocabulary.get_indexer(values)
+        codes[values.isna().to_numpy()] = self.positions[column][None]
+        return codes
+
+    def encode_data(self, data):
+        """Returns codes of the frame cells in the factors of the training data, -1 for unknown factors."""
+        codes = {}
+        for column in self.factors:
+            if column in data:
+                codes[column] = self._encode_values(column, self._bucketize(column, data[column]))
+            else:
+                codes[column] = np.full(len(data), -1, dtype=np.int64)
+        return codes
 
-        self.rows = [{column: factor for column, factor in data.items()} for index, data in
-                     data_no_target.iterrows()]
-        self.current_targets = self.predict_target_values()
+    def append_data(self, data_path, target_column):
+        """Appends rows to the training data; the next trainings solve only factors that have appended rows.
 
-        self.instance_multipliers = [1 for _ in range(0, len(self.rows))]
-        self.refresh_instance_multipliers()
+        Values not seen before become new factors with neutral additions and multipliers. Factors
+        without appended rows keep their values, so the cost of a training iteration depends on the
+        rows of the factors the appended rows have rather than on all rows.
+        """
+        data = self.read_data(data_path)
+        rows_count = len(self.target_values)
+        for column in self.factors:
+            values = data[column] if column in data else pandas.Series(None, index=data.index, dtype=object)
+            values = self._bucketize(column, values)
+            codes = self._encode_values(column, values)
+            unknown = codes < 0
+            new_codes, new_factors = pandas.factorize(values[unknown])
+            codes[unknown] = new_codes + len(self.factors[column])
+            for factor in new_factors.tolist():
+                if column in self.additions:
+                    self.additions[column][factor] = 0.0
+                if column in self.multipliers:
+                    self.multipliers[column][factor] = 1.0
+            self._set_column(column, self.factors[column] + new_factors.tolist(),
+                             np.concatenate([self.codes[column], codes]))
+        self.target_values = self._store('target_values', np.concatenate(
+            [self.target_values, data[target_column].to_numpy(dtype=np.float64)]))
+        if self.delta_start is None:
+            self.delta_start = rows_count
+        self.refresh_temporal_values()
+        print(f'Appended {len(data)} rows to {rows_count} rows', flush=True)
+
+    def save_state(self, path):
+        """Saves the encoded training data: targets, factors of every column and codes of every row."""
+        header = {'columns': [{'name': column, 'factors': self.factors[column]} for column in self.factors],
+                  'bins': self.bin_edges}
+        codes = {f'codes_{index}': self.codes[column] for index, column in enumerate(self.factors)}
+        _save_npz(path, header=np.array(json.dumps(header, ensure_ascii=False)),
+                  target_values=self.target_values, **codes)
+
+    def save_checkpoint(self, path, iterations, best_error=None, stalled=0):
+        """Saves what training continues from after iterations: factor values, per-row arrays and counters.
+
+        The encoded data is not included, it is saved once by save_state. The settings of the
+        training are saved too, so that it is not continued with other settings.
+        """
+        header = {'iterations': iterations, 'best_error': best_error, 'stalled': stalled, 'settings': self.settings,
+                  'solved_ratios': [[kind, column] for kind, column in self.solved_ratios],
+                  'additions': list(self.additions), 'multipliers': list(self.multipliers)}
+        arrays = {f'{kind}_{index}': self._column_values(getattr(self, kind), column)
+                  for kind in ('additions', 'multipliers') for index, column in enumerate(getattr(self, kind))}
+        arrays.update({f'solved_ratios_{index}': ratios for index, ratios in enumerate(self.solved_ratios.values())})
+        _save_npz(path, header=np.array(json.dumps(header)), addition_sums=self.addition_sums,
+                  instance_multipliers=self.instance_multipliers, current_targets=self.current_targets, **arrays)
+
+    def load_checkpoint(self, path):
+        """Restores a checkpoint saved by save_checkpoint, the next train continues after its iterations."""
+        with np.load(path) as checkpoint:
+            header = json.loads(str(checkpoint['header']))
+            for kind in ('additions', 'multipliers'):
+                setattr(self, kind, {column: dict(zip(self.factors[column], checkpoint[f'{kind}_{index}'].tolist()))
+                                     for index, column in enumerate(header[kind])})
+            self.addition_sums = checkpoint['addition_sums']
+            self.instance_multipliers = checkpoint['instance_multipliers']
+            self.current_targets = checkpoint['current_targets']
+            self.solved_ratios = {(kind, column): checkpoint[f'solved_ratios_{index}']
+                                  for index, (kind, column) in enumerate(header['solved_ratios'])}
+        self.resumed = {key: header.get(key) for key in ('iterations', 'best_error', 'stalled', 'settings')}
+        print(f'Resuming after {header["iterations"]} iterations from {path}', flush=True)
+
+    @classmethod
+    def load_state(cls, path, memmap_directory: str = None):
+        """Creates a predictor from a state saved by save_state without reading the data again."""
+        with np.load(path) as state:
+            header = json.loads(str(state['header']))
+            columns = {column['name']: (column['factors'], state[f'codes_{index}'])
+                       for index, column in enumerate(header['columns'])}
+            return cls._from_columns(state['target_values'], columns, header.get('bins', {}), memmap_directory)
+
+    def subset(self, rows, rarity_ignore: float = 0.0):
+        """Creates a predictor on the given rows without reading or factorizing the data again.
+
+        The factors are the same as a predictor created from these rows of the data would have:
+        values absent from the rows are dropped and values seen less than rarity_ignore share of
+        the rows times join the None factor.
+        """
+        minimum = len(rows) * rarity_ignore
+        columns = {}
+        for column, factors in self.factors.items():
+            codes = self.codes[column][rows]
+            none_code = self.positions[column][None]
+            counts = np.bincount(codes[codes >= 0], minlength=len(factors))
+            present, first_rows = np.unique(codes, return_index=True)
+            present = present[np.argsort(first_rows)]
+            present = present[(present >= 0) & (present != none_code)]
+            kept = present[counts[present] >= minimum]
+            remap = np.full(len(factors) + 1, -1, dtype=np.int32)
+            remap[present] = len(kept)
+            remap[none_code] = len(kept)
+            remap[kept] = np.arange(len(kept))
+            columns[column] = ([factors[code] for code in kept] + [None], remap[codes])
+        return self._from_columns(self.target_values[rows], columns, self.bin_edges)
+
+    @classmethod
+    def _from_columns(cls, target_values, columns: dict, bin_edges: dict, memmap_directory: str = None):
+        """Creates a predictor from targets, (factors, codes) of every column and bin edges of binned columns."""
+        predictor = cls.__new__(cls)
+        Predictor.__init__(predictor)
+        predictor.ignore = {'additions': [], 'multipliers': []}
+        predictor.bin_edges = bin_edges
+        predictor.memmap_directory = memmap_directory
+        if memmap_directory is not None:
+            os.makedirs(memmap_directory, exist_ok=True)
+        predictor.factors, predictor.positions, predictor.codes, predictor.instances = {}, {}, {}, {}
+        predictor.target_values = predictor._store('target_values', np.asarray(target_values, dtype=np.float64))
+        for column, (factors, codes) in columns.items():
+            predictor._set_column(column, factors, codes)
+        predictor.additions = {column: {factor: 0.0 for factor in factors}
+                               for column, factors in predictor.factors.items()}
+        predictor.multipliers = {column: {factor: 1.0 for factor in factors}
+                                 for column, factors in predictor.factors.items()}
+        predictor.solver_pool = None
+        predictor.change_threshold = None
+        predictor.solved_ratios = {}
+        predictor.delta_start = None
+        predictor.timing_log = None
+        predictor.iteration = 0
+        predictor.resumed = None
+        predictor.settings = None
+        predictor.refresh_temporal_values()
+        return predictor
+
+    def _reset_values(self):
+        """Restores the neutral additions and multipliers training starts from."""
+        self.additions = {column: {factor: 0.0 for factor in factors} for column, factors in self.factors.items()}
+        self.multipliers = {column: {factor: 1.0 for factor in factors} for column, factors in self.factors.items()}
+        self.solved_ratios = {}
+        self.resumed = None
+        self.refresh_temporal_values()
+
+    def predict_target_values(self, data=None):
+        if data is not None:
+            codes = self.encode_data(data)
+            return self._get_addition_sums(codes) * self._get_multiplier_products(codes)
+        return self._get_addition_sums() * self._get_multiplier_products()
 
     def refresh_current_targets(self):
-        self.current_targets = self.predict_target_values()
+        self.current_targets = self.addition_sums * self.instance_multipliers
 
-    def refresh_instance_multipliers(self):
-        self.instance_multipliers = [1 for _ in range(0, len(self.rows))]
-        for column in self.factors_instances:
-            for factor in self.factors_instances[column]:
-                for index in self.factors_instances[column][factor]:
-                    self.instance_multipliers[index] *= self.multipliers[column][factor]
+    def refresh_addition_sums(self):
+        self.addition_sums = self._get_addition_sums()
 
-    def refresh_temporal_values(self):
-        self.refresh_current_targets()
-        self.refresh_instance_multipliers()
+    def refresh_instance_multipliers(self):
+        self.instance_multipliers = self._get_multiplier_products()
+
+    def refresh_temporal_values(self, additions=True, multipliers=True, rows=None):
+        """Recomputes per-row sums of additions and products of multipliers that may have changed.
+
+        Sums and products are accumulated column after column as predict_target_value does,
+        so current targets are exactly the predicted values. With rows, only these rows are recomputed.
+        """
+        if rows is None:
+            if additions:
+                self.refresh_addition_sums()
+            if multipliers:
+                self.refresh_instance_multipliers()
+            self.refresh_current_targets()
+            return
+        codes = {column: self.codes[column][rows] for column in self.codes}
+        if additions:
+            self.addition_sums[rows] = self._get_addition_sums(codes)
+        if multipliers:
+            self.instance_multipliers[rows] = self._get_multiplier_products(codes)
+        self.current_targets[rows] = self.addition_sums[rows] * self.instance_multipliers[rows]
 
     @staticmethod
     def mean_absolute_percentage_error(y_true, y_pred):
         y_true, y_pred = np.array(y_true), np.array(y_pred)
         return np.mean(np.abs((y_true - y_pred) / y_true)) * 100
 
-    def find_prediction_error(self):
-        predicted_values = self.predict_target_values()
-        return self.mean_absolute_percentage_error(self.target_values, predicted_values)
+    def find_prediction_error(self, data=None, target_values=None):
+        if data is None:
+            return self.mean_absolute_percentage_error(self.target_values, self.predict_target_values())
+        return self.mean_absolute_percentage_error(target_values, self.predict_target_values(data))
 
     def _load_factors_values(self, filename):
-        [values, multipliers] = np.load(filename, allow_pickle=True)
+        header = read_header(filename)
+        if (header or {}).get('bins', {}) != self.bin_edges:
+            print(f'Bins of {filename} differ from the bins of the training data, binned factors may not match',
+                  flush=True)
+        [values, multipliers] = read_factors(filename)
         for column in self.additions:
             if column in values:
                 for factor in self.additions[column]:
@@ -145,95 +566,139 @@ class TrainingPredictor(Predictor):
                         self.multipliers[column][factor] = multipliers[column][factor]
 
     def _get_optimal_factor_addition(self, column, factor):
-        entities = [Entity(self.target_values[instance],
-                           self.current_targets[instance],
-                           self.instance_multipliers[instance])
-                    for instance
-                    in self.factors_instances[column][factor]]
-
-        entities.sort(key=lambda entity: entity.get_difference())
-        derivative = sum([entity.get_mape_addition_derivative() for entity in entities])
-        difference = 0
-        direction = 1
-        if derivative < 0:
-            direction = -1
-            entities.reverse()
-        if derivative != 0:
-            for entity in entities:
-                if derivative * direction < 0:
-                    break
-                if entity.get_difference() * direction > 0:
-                    difference = entity.get_difference()
-                    derivative -= entity.get_mape_addition_derivative()
-                    entity.predicted_value = entity.target_value
-                if entity.get_difference() == 0:
-                    entity.predicted_value += direction
-                    derivative += entity.get_mape_addition_derivative()
-        return difference
+        instances = self.get_factor_instances(column, factor)
+        return get_optimal_addition(self.target_values[instances],
+                                    self.current_targets[instances],
+                                    self.instance_multipliers[instances])
 
     def _get_optimal_factor_multiplier(self, column, factor):
-        entities = [Entity(self.target_values[instance],
-                           self.current_targets[instance],
-                           self.instance_multipliers[instance])
-                    for instance
-                    in self.factors_instances[column][factor]]
-
-        entities.sort(key=lambda entity: entity.get_coefficient())
-        derivative = sum([entity.get_mape_multiplier_derivative(1) for entity in entities])
-        coefficient = 1
-        direction = 1
-        if derivative < 0:
-            direction = -1
-            entities.reverse()
-        if derivative != 0:
-            for entity in entities:
-                if derivative * direction < 0:
-                    break
-                if entity.get_coefficient() * direction > 1 * direction:
-                    coefficient = entity.get_coefficient()
-                    derivative -= entity.get_mape_multiplier_derivative(1)
-                    entity.predicted_value = entity.target_value
-                    entity.multiplier *= coefficient
-                if entity.get_coefficient() == 1:
-                    entity.predicted_value *= 2
-                    derivative += entity.get_mape_multiplier_derivative(coefficient * 2) * direction
-        return coefficient
+        instances = self.get_factor_instances(column, factor)
+        return get_optimal_multiplier(self.target_values[instances],
+                                      self.current_targets[instances],
+                                      self.instance_multipliers[instances])
+
+    def _get_changed_positions(self, kind, column):
+        """Returns positions of the column factors that have to be solved.
+
+        After append_data only factors that have appended rows are solved. With change tracking a
+        factor is skipped while the mean prediction to target ratio of its instances moved by at most
+        change_threshold since it was last solved: its residuals moved little, so its optimum did too.
+        """
+        offsets, indexes = self.instances[column]
+        sizes = np.diff(offsets)
+        if self.delta_start is not None:
+            # Row indexes of every factor are sorted, so the last one tells if the factor has appended rows
+            last_rows = np.full(len(sizes), -1, dtype=np.int64)
+            last_rows[sizes > 0] = indexes[offsets[1:][sizes > 0] - 1]
+            return np.flatnonzero(last_rows >= self.delta_start)
+        solved_ratios = self.solved_ratios.get((kind, column))
+        if self.change_threshold is None or solved_ratios is None:
+            return np.arange(len(self.factors[column]))
+        return np.flatnonzero(np.abs(self._factor_ratios(column) - solved_ratios) > self.change_threshold * sizes)
+
+    def _factor_ratios(self, column):
+        """Returns sums of the prediction to target ratios of the rows of every factor of the column."""
+        offsets, indexes = self.instances[column]
+        sizes = np.diff(offsets)
+        ratios = np.zeros(len(sizes))
+        if len(indexes) > 0:
+            ratios[sizes > 0] = np.add.reduceat(self.current_targets[indexes] / self.target_values[indexes],
+                                                offsets[:-1][sizes > 0])
+        return ratios
+
+    def _solve_column(self, kind, column, positions):
+        """Returns optimal values of the factors of the column at the given positions."""
+        factors = [self.factors[column][position] for position in positions]
+        if self.solver_pool is None:
+            solve = self._get_optimal_factor_addition if kind == 'additions' else self._get_optimal_factor_multiplier
+            values = [solve(column, factor) for factor in factors]
+        else:
+            values = self.solver_pool.solve(kind, column, self.current_targets, self.instance_multipliers, positions)
+        return dict(zip(factors, values))
+
+    def _track_changes(self, kind, column, positions):
+        """Remembers the ratio sums the solved factors of the column were solved at."""
+        if self.change_threshold is None:
+            return
+        solved_ratios = self.solved_ratios.setdefault((kind, column), np.zeros(len(self.factors[column])))
+        solved_ratios[positions] = self._factor_ratios(column)[positions]
+
+    def _train_column(self, kind, column):
+        """Solves the column factors that have to be solved and refreshes the rows that have them."""
+        start = perf_counter()
+        positions = self._get_changed_positions(kind, column)
+        if len(positions) == 0:
+            self._log_timing('solve', perf_counter() - start, kind=kind, column=column, factors=0)
+            return
+        part = len(positions) < len(self.factors[column])
+        if part:
+            selected = np.zeros(len(self.factors[column]) + 1, dtype=bool)
+            selected[positions] = True
+            rows = np.flatnonzero(selected[self.codes[column]])
+        else:
+            rows = self.codes[column] >= 0
+        codes = {column: self.codes[column][rows]}
+        if kind == 'additions':
+            factor_additions = self._gather(self.additions, column, 0.0, codes)
+            self.current_targets[rows] -= factor_additions * self.instance_multipliers[rows]
+        else:
+            factor_multipliers = self._gather(self.multipliers, column, 1.0, codes)
+            self.current_targets[rows] /= factor_multipliers
+            self.instance_multipliers[rows] /= factor_multipliers
+        getattr(self, kind)[column].update(self._solve_column(kind, column, positions))
+        solved = perf_counter()
+        self.refresh_temporal_values(additions=kind == 'additions', multipliers=kind == 'multipliers',
+                                     rows=rows if part else None)
+        self._track_changes(kind, column, positions)
+        self._log_timing('solve', solved - start, kind=kind, column=column, factors=len(positions))
+        self._log_timing('refresh_temporal_values', perf_counter() - solved, kind=kind, column=column)
+
+    def _log_timing(self, step, seconds, **fields):
+        """Appends one JSON line to the timing log when it is open."""
+        if self.timing_log is not None:
+            record = dict(time=time(), iteration=self.iteration, step=step, seconds=seconds, **fields)
+            self.timing_log.write(json.dumps(record) + '\n')
 
     def _train_once(self):
-        for column in self.additions:
-            if column in self.ignore['additions']:
-                continue
-            column_additions = self.additions[column]
-            print(f'Calculating addition: {column}', flush=True)
-            for factor in column_additions:
-                factor_value = column_additions[factor]
-                for instance in self.factors_instances[column][factor]:
-                    self.current_targets[instance] -= factor_value * self.instance_multipliers[instance]
-                new_value = self._get_optimal_factor_addition(column, factor)
-                column_additions[factor] = new_value
-            self.refresh_temporal_values()
-        for column in self.multipliers:
-            if column in self.ignore['multipliers']:
-                continue
-            column_multipliers = self.multipliers[column]
-            print(f'Calculating multiplier: {column}', flush=True)
-            for factor in column_multipliers:
-                factor_multiplier = column_multipliers[factor]
-                for instance in self.factors_instances[column][factor]:
-                    self.current_targets[instance] /= factor_multiplier
-                    self.instance_multipliers[instance] /= factor_multiplier
-                new_multiplier = self._get_optimal_factor_multiplier(column, factor)
-                column_multipliers[factor] = new_multiplier
-            self.refresh_temporal_values()
+        for kind in ('additions', 'multipliers'):
+            for column in getattr(self, kind):
+                if column in self.ignore[kind]:
+                    continue
+                print(f'Calculating {kind[:-1]}: {column}', flush=True)
+                self._train_column(kind, column)
 
     def train(self, times=1, factors_values_filename: str = None, ignore: dict = None,
-              save_period=1, models_directory=''):
-        if len(models_directory) > 0:
+              save_period=1, models_directory='', workers=1, tolerance: float = None, patience=1,
+              validation_path: str = None, validation_target: str = None, change_threshold: float = None,
+              timing_log_path: str = None, checkpoint_path: str = None):
+        """Runs up to times training iterations.
+
+        With tolerance, training stops after patience iterations in a row that improve the best
+        error by less than this relative amount. The error is measured on the validation data when
+        validation_path is given. With change_threshold, a factor is not solved again while the mean
+        ratio of prediction to target of its instances moved by at most this amount since it was last
+        solved (0 solves it again after any change). With timing_log_path, durations of every
+        column step and iteration are appended to this file as JSON lines. With checkpoint_path, a
+        checkpoint is saved there after every iteration; after load_checkpoint, iterations continue
+        from the checkpoint up to times and factors_values_filename is not loaded again, unless the
+        checkpoint was saved with other ignore lists, factors values, validation data, tolerance,
+        patience or change_threshold: then training starts from the beginning.
+
+        Returns the path of the last saved model; with models_directory None no model is saved.
+        """
+        settings = training_settings(factors_values_filename, ignore if ignore is not None else self.ignore,
+                                     validation_path, validation_target, tolerance, patience, change_threshold)
+        if self.resumed is not None and self.resumed['settings'] != settings:
+            print('The checkpoint was saved with other training settings, starting from the beginning', flush=True)
+            self._reset_values()
+        self.settings = settings
+        if models_directory is not None and len(models_directory) > 0:
             if models_directory[-1] != '/' or models_directory[-1] != '\\':
                 models_directory += '/'
         if ignore is not None:
             self.ignore = ignore
-        if factors_values_filename is not None:
+        if factors_values_filename is not None and self.resumed is None:
+            # A resumed checkpoint already holds the values trained from these factors values
             self._load_factors_values(factors_values_filename)
             if ignore is not None:
                 if 'additions' in ignore:
@@ -250,37 +715,149 @@ class TrainingPredictor(Predictor):
                         else:
                             for factor in self.multipliers[column]:
                                 self.multipliers[column][factor] = 1
-        self.current_targets = self.predict_target_values()
-        for index in range(times):
+            self.refresh_temporal_values()
+        validation = None
+        if validation_path is not None:
+            validation_data = self.read_data(validation_path)
+            validation = (validation_data.drop(columns=[validation_target]),
+                          validation_data[validation_target].to_numpy())
+        if change_threshold is None:
+            self.solved_ratios = {}
+        self.change_threshold = change_threshold
+        if workers > 1:
+            self.solver_pool = ColumnSolverPool(self, workers)
+        if timing_log_path is not None:
+            self.timing_log = open(timing_log_path, 'a', buffering=1)
+        try:
+            return self._train(times, save_period, models_directory, tolerance, patience, validation, checkpoint_path)
+        finally:
+            if self.solver_pool is not None:
+                self.solver_pool.close()
+                self.solver_pool = None
+            if self.timing_log is not None:
+                self.timing_log.close()
+                self.timing_log = None
+
+    def _train(self, times, save_period, models_directory, tolerance, patience, validation, checkpoint_path):
+        saved = False
+        best_error = None
+        stalled = 0
+        first = 0
+        if self.resumed is not None:
+            first, best_error, stalled = self.resumed['iterations'], self.resumed['best_error'], self.resumed['stalled']
+            self.resumed = None
+        for index in range(first, times):
+            if tolerance is not None and stalled >= patience:
+                print(f'Error improved by less than {tolerance} for {stalled} iterations, stopping', flush=True)
+                break
+            self.iteration = index
             start = time()
             self._train_once()
             error = self.find_prediction_error()
-            print(f'Train #{index} for {time() - start} s with {error}% error', flush=True)
-            if save_period != 0 and (index + 1) % save_period == 0:
+            message = f'Train #{index} for {time() - start} s with {error}% error'
+            stopping_error = error
+            if validation is not None:
+                stopping_error = self.find_prediction_error(*validation)
+                message += f' and {stopping_error}% validation error'
+            self._log_timing('iteration', time() - start, error=error,
+                             validation_error=None if validation is None else stopping_error)
+            print(message, flush=True)
+            saved = models_directory is not None and save_period != 0 and (index + 1) % save_period == 0
+            if saved:
                 path = f'{models_directory}{int(time())}_{error}.npy'
-                np.save(path, [self.additions, self.multipliers])
+                save_model(path, self.additions, self.multipliers, error, self.bin_edges)
                 print(f' was saved in {path}')
             else:
                 print()
-        if save_period == 0 or times % save_period != 0:
+            if tolerance is not None:
+                if best_error is not None and (best_error - stopping_error) < tolerance * best_error:
+                    stalled += 1
+                else:
+                    stalled = 0
+                best_error = stopping_error if best_error is None else min(best_error, stopping_error)
+            if checkpoint_path is not None:
+                self.save_checkpoint(checkpoint_path, index + 1, best_error, stalled)
+        if models_directory is None:
+            return None
+        if not saved:
             error = self.find_prediction_error()
             path = f'{models_directory}{int(time())}_{error}.npy'
-            np.save(path, [self.additions, self.multipliers])
+            save_model(path, self.additions, self.multipliers, error, self.bin_edges)
             print(f'Train result was saved in {path}', flush=True)
+        return path
 
 
-def main(argv):
+def _save_npz(path, **arrays):
+    """Writes the arrays to a temporary file that then replaces path, so an interrupted write keeps the old file."""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix='.npz', delete=False) as file:
+        np.savez(file, **arrays)
+    os.replace(file.name, path)
+
+
+def _hash_file(digest, path):
+    """Feeds the file contents to the digest and returns it."""
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest
+
+
+def data_key(data_path, target_column, bins: dict = None):
+    """Returns a hash of the data file contents and of the settings its encoding depends on."""
+    digest = _hash_file(hashlib.sha256(), data_path)
+    digest.update(json.dumps([target_column, bins], sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def training_settings(factors_values_filename, ignore: dict, validation_path, validation_target, tolerance,
+                      patience, change_threshold):
+    """Returns the training arguments the trained values depend on as JSON values; files are given by content hashes."""
+    files = {'factors_values': factors_values_filename, 'validation': validation_path}
+    settings = {name: None if path is None else _hash_file(hashlib.sha256(), path).hexdigest()[:16]
+                for name, path in files.items()}
+    settings.update(ignore={kind: sorted(columns) for kind, columns in ignore.items()},
+                    validation_target=validation_target if validation_path is not None else None,
+                    tolerance=tolerance, patience=patience if tolerance is not None else None,
+                    change_threshold=change_threshold)
+    return settings
+
+
+def checkpoint_paths(checkpoint_directory, data_path, target_column, bins: dict = None):
+    """Returns paths of the encoded data and of the training checkpoint of the data in checkpoint_directory."""
+    key = data_key(data_path, target_column, bins)
+    return (os.path.join(checkpoint_directory, f'{key}_state.npz'),
+            os.path.join(checkpoint_directory, f'{key}_checkpoint.npz'))
+
+
+def default_ignore():
+    """Columns that get no additions or no multipliers when training the service model."""
     blacklist = ['engine_capacity', 'zipcode', 'city']
     ignore = {'additions': [column for column in blacklist], 'multipliers': [column for column in blacklist]}
     ignore['additions'] += ['brand', 'type', 'mileage', 'power']
     ignore['multipliers'] += ['fuel']
+    return ignore
+
+
+def main(argv):
+    ignore = default_ignore()
     input_train_data_path = None
     target = None
+    state_path = None
+    delta_path = None
     training_kwargs = {}
+    bins = None
+    memmap_directory = None
+    checkpoint_directory = None
     help_message = ' -i <input_train_data_path> -g <target> [-t <iterations_count>' \
-                   ' -f <factors_values_filename> -s <save_period>]'
+                   ' -f <factors_values_filename> -s <save_period> --workers <processes_count>' \
+                   ' -v <validating_data_path> --tolerance <relative_improvement> --patience <iterations_count>' \
+                   ' --track-changes <relative_change> --state <training_state_path> --delta <appended_data_path>' \
+                   ' --timing-log <jsonl_path> --bins <column:quantile|width:count,...> --memmap <directory>' \
+                   ' --checkpoint <directory>]'
     try:
-        opts, args = getopt.getopt(argv, "hi:g:t:f:s:", [])
+        opts, args = getopt.getopt(argv, "hi:g:t:f:s:v:", ["workers=", "tolerance=", "patience=", "track-changes=",
+                                                           "state=", "delta=", "timing-log=", "bins=", "memmap=",
+                                                           "checkpoint="])
     except getopt.GetoptError:
         print(help_message)
         sys.exit(2)
@@ -298,11 +875,60 @@ def main(argv):
             training_kwargs["factors_values_filename"] = arg
         elif opt == "-s":
             training_kwargs["save_period"] = int(arg)
-    if input_train_data_path is not None and target is not None:
-        predictor = TrainingPredictor(input_train_data_path, target)
-        predictor.train(ignore=ignore, **training_kwargs)
+        elif opt == "--workers":
+            training_kwargs["workers"] = int(arg)
+        elif opt == "-v":
+            training_kwargs["validation_path"] = arg
+        elif opt == "--tolerance":
+            training_kwargs["tolerance"] = float(arg)
+        elif opt == "--patience":
+            training_kwargs["patience"] = int(arg)
+        elif opt == "--track-changes":
+            training_kwargs["change_threshold"] = float(arg)
+        elif opt == "--state":
+            state_path = arg
+        elif opt == "--delta":
+            delta_path = arg
+        elif opt == "--timing-log":
+            training_kwargs["timing_log_path"] = arg
+        elif opt == "--bins":
+            bins = parse_bins(arg)
+        elif opt == "--memmap":
+            memmap_directory = arg
+        elif opt == "--checkpoint":
+            checkpoint_directory = arg
+    if delta_path is not None and state_path is not None and target is not None \
+            and "factors_values_filename" in training_kwargs and checkpoint_directory is None:
+        predictor = TrainingPredictor.load_state(state_path, memmap_directory)
+        predictor.append_data(delta_path, target)
+        predictor.train(ignore=ignore, validation_target=target, **training_kwargs)
+        predictor.save_state(state_path)
+    elif delta_path is None and input_train_data_path is not None and target is not None:
+        encoded_path = None
+        if checkpoint_directory is not None:
+            os.makedirs(checkpoint_directory, exist_ok=True)
+            encoded_path, training_kwargs["checkpoint_path"] = checkpoint_paths(checkpoint_directory,
+                                                                                input_train_data_path, target, bins)
+        if encoded_path is not None and os.path.exists(encoded_path):
+            predictor = TrainingPredictor.load_state(encoded_path, memmap_directory)
+            if os.path.exists(training_kwargs["checkpoint_path"]):
+                predictor.load_checkpoint(training_kwargs["checkpoint_path"])
+        else:
+            predictor = TrainingPredictor(input_train_data_path, target, bins=bins, memmap_directory=memmap_directory)
+            if encoded_path is not None:
+                predictor.save_state(encoded_path)
+        predictor.train(ignore=ignore, validation_target=target, **training_kwargs)
+        if state_path is not None:
+            predictor.save_state(state_path)
     else:
-        if input_train_data_path is None:
+        if delta_path is not None:
+            if state_path is None:
+                print("Wrong --state")
+            if "factors_values_filename" not in training_kwargs:
+                print("Wrong -f")
+            if checkpoint_directory is not None:
+                print("Wrong --checkpoint")
+        elif input_train_data_path is None:
             print("Wrong -i")
         if target is None:
             print("Wrong -g")